@@ -1,14 +1,17 @@
 import uvicorn
-# import baby_sitter
+from configs import settings, reset_global_settings
 from server import sio_app as app
+from server.utils.ws_compression import CompressionWebSocketProtocol
 
 
-# Start monitoring
-# baby_sitter.run()
-
 def main():
     # Start blocking HTTP server
-    uvicorn.run(app)
+    if settings.AGENT_WORKERS > 1:
+        reset_global_settings()
+        # Each worker process imports the app by itself
+        uvicorn.run('agent:app', workers=settings.AGENT_WORKERS, ws=CompressionWebSocketProtocol)
+    else:
+        uvicorn.run(app, ws=CompressionWebSocketProtocol)
 
 
 if __name__ == '__main__':
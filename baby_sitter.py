@@ -0,0 +1,120 @@
+"""
+Watchdog of the event loop.
+
+A blocked event loop cannot measure itself, so a separate thread schedules a callback
+on the loop every ``STALL_CHECK_INTERVAL`` seconds. If the callback does not run within
+``STALL_THRESHOLD`` seconds, the stack of the loop thread is captured while it is still
+blocked, so that the call causing the stall is recorded.
+
+It also samples stacks of the loop thread on demand. See :func:`profile`.
+"""
+import sys
+import time
+import asyncio
+import threading
+import traceback
+from collections import Counter, deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional
+
+from configs import settings
+from server.utils import metrics
+
+stalls: Deque[dict] = deque(maxlen=settings.STALL_HISTORY_SIZE)  # Recent stalls, the oldest first
+stall_count = metrics.Counter('agent_event_loop_stalls_total',
+                              'Times the event loop was blocked longer than STALL_THRESHOLD')
+
+_watchdog: Optional[threading.Thread] = None
+_loop_thread_id: Optional[int] = None
+_profile_lock = threading.Lock()
+
+
+def run():
+    """ Start watching the running event loop """
+    global _watchdog, _loop_thread_id
+
+    if _watchdog is not None and _watchdog.is_alive():
+        return
+
+    _loop_thread_id = threading.get_ident()
+    _watchdog = threading.Thread(target=_watch, args=(asyncio.get_running_loop(), _loop_thread_id),
+                                 name='baby_sitter', daemon=True)
+    _watchdog.start()
+
+
+def _watch(loop: asyncio.AbstractEventLoop, thread_id: int):
+    beat = threading.Event()
+
+    while not loop.is_closed():
+        beat.clear()
+        sent = time.monotonic()
+        try:
+            loop.call_soon_threadsafe(beat.set)
+        except RuntimeError:  # Loop is closed
+            return
+
+        if not beat.wait(settings.STALL_THRESHOLD):
+            frame = sys._current_frames().get(thread_id)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            del frame
+
+            while not beat.wait(settings.STALL_CHECK_INTERVAL):
+                if loop.is_closed():
+                    return
+            _record(time.monotonic() - sent, stack)
+
+        time.sleep(settings.STALL_CHECK_INTERVAL)
+
+
+def _record(lag: float, stack: List[str]):
+    stall_count.inc()
+    stalls.append({
+        'at': datetime.now().isoformat(timespec='milliseconds'),
+        'lag': round(lag, 3),
+        'stack': [line.rstrip() for line in stack],
+    })
+    print(f'Event loop was blocked for {lag:.3f}s at\n{"".join(stack)}', end='')
+
+
+def _collapse(frame) -> str:
+    """ Stack of ``frame`` from the outermost call, as `file:function:line;...` """
+    calls = []
+    while frame is not None:
+        code = frame.f_code
+        calls.append(f'{code.co_filename}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    return ';'.join(reversed(calls))
+
+
+def profile(seconds: float, top: int = 20, thread_id: Optional[int] = None) -> Dict:
+    """
+    Sample stacks of the loop thread for ``seconds`` and aggregate them.
+    This blocks, so run it in another thread. Only one profile runs at a time.
+
+    :return: number of samples and the ``top`` most frequent stacks
+    """
+    thread_id = thread_id or _loop_thread_id
+    if thread_id is None:
+        raise RuntimeError('Event loop is not watched')
+    if not _profile_lock.acquire(blocking=False):
+        raise RuntimeError('Profiling is in progress')
+
+    try:
+        stacks = Counter()
+        samples = 0
+        deadline = time.monotonic() + min(seconds, settings.PROFILE_MAX_SECONDS)
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stacks[_collapse(frame)] += 1
+                samples += 1
+            del frame
+            time.sleep(settings.PROFILE_INTERVAL)
+    finally:
+        _profile_lock.release()
+
+    return {
+        'samples': samples,
+        'stacks': [{'stack': stack.split(';'), 'count': count, 'ratio': round(count / samples, 4)}
+                   for stack, count in stacks.most_common(top)],
+    }
@@ -0,0 +1,66 @@
+"""
+Measure per-keystroke overhead of the `SSH` event handler, with and without the
+per-sid binding made on SSH_CONNECT.
+
+A fake engine.io socket is registered so that session lookups take the real path
+of python-socketio, and the worker discards input, so that only the handler
+overhead is measured.
+
+Usage:
+    $ python -m benchmarks.keystroke_handler --count 100000
+"""
+import time
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+from server import sio
+from server.routers import ssh as ssh_router
+from server.utils import ws_session
+
+
+class NullWorker:
+    async def recv_from_client(self, data):
+        pass
+
+
+async def connect_fake_client() -> str:
+    eio_sid = 'bench-eio-sid'
+    sio.eio.sockets[eio_sid] = SimpleNamespace(closed=False, session={})
+    sid = sio.manager.connect(eio_sid, '/')
+    await ws_session.update(sid, {'ip': '127.0.0.1', 'valid': True, 'ssh': NullWorker()})
+    return sid
+
+
+async def measure(sid: str, count: int) -> float:
+    """ Return nanoseconds per keystroke """
+    handler = ssh_router.recv_from_client
+    start = time.perf_counter_ns()
+    for _ in range(count):
+        await handler(sid, 'a')
+    return (time.perf_counter_ns() - start) / count
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=100_000)
+    args = parser.parse_args()
+
+    sid = await connect_fake_client()
+    worker = await ws_session.get(sid, 'ssh')
+
+    ssh_router.bindings.pop(sid, None)
+    await measure(sid, 1000)  # Warm up
+    unbound = await measure(sid, args.count)
+
+    ssh_router.bindings[sid] = worker
+    await measure(sid, 1000)
+    bound = await measure(sid, args.count)
+
+    print(f'unbound(session lookup): {unbound / 1000:.2f} us/keystroke')
+    print(f'bound(fast path)       : {bound / 1000:.2f} us/keystroke')
+    print(f'speedup                : {unbound / bound:.1f}x')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,251 @@
+"""
+End-to-end load benchmark of the agent.
+
+The ASGI app(``server:sio_app``) is started in a separate uvicorn process, with
+- a local paramiko SSH server in place of the container's sshd
+- a stub HTTP server in place of the API server and the bridge server
+and ``--clients`` socket.io clients go through AUTHENTICATE -> SSH_CONNECT -> SSH concurrently.
+
+It reports
+- connect latency: time from SSH_CONNECT to the first SSH_RELAY
+- echo latency: time from sending one keystroke to receiving its echo
+- bulk output: throughput of `cat` of a large file, per session and in total
+- agent CPU: CPU time of the agent process per session, for each phase
+
+Settings of the agent can be overridden to compare them, ex. ``--env SSH_RELAY_EVENT_DRIVEN=false``.
+
+Usage:
+    $ python -m benchmarks.load --clients 10
+    $ python -m benchmarks.load --clients 50 --size-mb 4 --env TERMINAL_BACKEND=pty
+"""
+import os
+import sys
+import time
+import queue
+import argparse
+import tempfile
+import threading
+import statistics
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+import requests
+import socketio
+
+from benchmarks.standins import SSHServer, StubServer, free_port
+from server.websocket import InEvent, OutEvent
+
+MB = 1024 * 1024
+DONE_MARKER = b'__BENCH_DONE__'
+SSH_USER = 'bench'
+SSH_PASSWORD = 'bench'
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Agent:
+    """ Agent running in a uvicorn process """
+
+    def __init__(self, port: int, env: Dict[str, str]):
+        self.port = port
+        self.url = f'http://127.0.0.1:{port}'
+        self.env = dict(os.environ, **env)
+        self.proc = None
+
+    def start(self, timeout: float = 30):
+        self.proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'server:sio_app',
+                                      '--host', '127.0.0.1', '--port', str(self.port),
+                                      '--log-level', 'warning'],
+                                     cwd=REPO_DIR, env=self.env)
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.proc.poll() is not None:
+                raise RuntimeError(f'Agent exited with {self.proc.returncode}')
+            try:
+                requests.get(f'{self.url}/ping', timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise TimeoutError('Agent did not start')
+
+    def stop(self):
+        self.proc.terminate()
+        self.proc.wait()
+
+    def cpu_time(self) -> float:
+        """ User + system CPU seconds used by the agent process so far """
+        with open(f'/proc/{self.proc.pid}/stat', 'rt') as fp:
+            fields = fp.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Client:
+    """ socket.io client acting as a browser terminal """
+
+    def __init__(self, url: str, index: int):
+        self.url = url
+        self.index = index
+        self.output = queue.Queue()  # (received at, data)
+        self.errors = []
+        self._authenticated = threading.Event()
+
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on(OutEvent.AUTHENTICATE, lambda data: self._authenticated.set())
+        self.sio.on(OutEvent.SSH_RELAY, lambda data: self.output.put((time.perf_counter(), data)))
+        self.sio.on(OutEvent.ERROR, self.errors.append)
+
+    def connect(self, timeout: float = 30) -> float:
+        """ Open a terminal. Return seconds from SSH_CONNECT to the first output """
+
+        self.sio.connect(self.url, transports=['websocket'])
+        self.sio.emit(InEvent.AUTHENTICATE, {'token': f'bench-{self.index}'})
+        if not self._authenticated.wait(timeout):
+            raise TimeoutError(f'Client {self.index} is not authenticated: {self.errors}')
+
+        start = time.perf_counter()
+        self.sio.emit(InEvent.SSH_CONNECT, {})
+        received_at, _ = self._get(timeout)
+        elapsed = received_at - start
+
+        # Wait for the prompt and discard the login messages
+        self.sio.emit(InEvent.SSH, 'echo __BENCH_""DONE__\n')
+        self.read_until(DONE_MARKER, timeout)
+        self.drain(0.2)
+        return elapsed
+
+    def echo(self, count: int, interval: float, timeout: float = 10) -> List[float]:
+        """ Type ``count`` keystrokes ``interval`` seconds apart. Return the echo latencies in seconds """
+
+        latencies = []
+        for _ in range(count):
+            time.sleep(interval)
+            self.drain(0)
+            start = time.perf_counter()
+            self.sio.emit(InEvent.SSH, 'x')
+            received_at, _ = self._get(timeout)
+            latencies.append(received_at - start)
+
+        # Clear the typed line
+        self.sio.emit(InEvent.SSH, '\x15')
+        self.drain(0.2)
+        return latencies
+
+    def bulk(self, path: str, timeout: float = 600) -> Dict[str, float]:
+        """ `cat` ``path`` and receive all of it """
+
+        start = time.perf_counter()
+        self.sio.emit(InEvent.SSH, f'cat {path}; echo __BENCH_""DONE__\n')
+        received = self.read_until(DONE_MARKER, timeout)
+        return {'bytes': received, 'seconds': time.perf_counter() - start}
+
+    def read_until(self, marker: bytes, timeout: float) -> int:
+        """ Read output until ``marker`` shows up. Return the number of bytes read """
+
+        deadline = time.monotonic() + timeout
+        tail = b''
+        total = 0
+        while True:
+            _, data = self._get(deadline - time.monotonic())
+            total += len(data)
+            tail += data
+            if marker in tail:
+                return total
+            tail = tail[-len(marker):]
+
+    def drain(self, quiet: float):
+        """ Discard output until nothing is received for ``quiet`` seconds """
+        try:
+            while True:
+                self.output.get(timeout=quiet) if quiet else self.output.get_nowait()
+        except queue.Empty:
+            pass
+
+    def close(self):
+        self.sio.disconnect()
+
+    def _get(self, timeout: float):
+        try:
+            return self.output.get(timeout=max(timeout, 0))
+        except queue.Empty:
+            raise TimeoutError(f'Client {self.index} received no output: {self.errors}') from None
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    return {
+        'p50': statistics.median(values),
+        'p90': values[int(len(values) * 0.9) - 1],
+        'p99': values[max(int(len(values) * 0.99) - 1, 0)],
+        'max': values[-1],
+    }
+
+
+def run_phase(agent: Agent, clients: List[Client], func: Callable[[Client], object]):
+    """ Run ``func`` on every client concurrently. Return the results and agent CPU seconds per session """
+
+    cpu = agent.cpu_time()
+    with ThreadPoolExecutor(len(clients)) as executor:
+        results = list(executor.map(func, clients))
+    return results, (agent.cpu_time() - cpu) / len(clients)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=10, help='number of concurrent sessions')
+    parser.add_argument('--keystrokes', type=int, default=100, help='keystrokes per session')
+    parser.add_argument('--typing-interval', type=float, default=0.1, help='seconds between keystrokes')
+    parser.add_argument('--size-mb', type=int, default=8, help='size of the file each session `cat`s')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                        help='setting of the agent to override')
+    args = parser.parse_args()
+
+    ssh_server = SSHServer(SSH_USER, SSH_PASSWORD)
+    stub = StubServer(SSH_USER, SSH_PASSWORD)
+    env = {
+        'SERVER_INIT': 'true',
+        'BRIDGE_KEY': 'bench',
+        'API_URL': stub.url,
+        'BRIDGE_URL': stub.url,
+        'SSH_PORT': str(ssh_server.port),
+        'SSH_MAX_WORKERS': str(max(args.clients * 2, 100)),
+    }
+    env.update(item.split('=', 1) for item in args.env)
+    agent = Agent(free_port(), env)
+
+    with tempfile.NamedTemporaryFile(suffix='.txt') as bulk_file:
+        line = b'a' * 79 + b'\n'
+        bulk_file.write(line * (args.size_mb * MB // len(line)))
+        bulk_file.flush()
+
+        ssh_server.start()
+        stub.start()
+        agent.start()
+        clients = [Client(agent.url, i + 1) for i in range(args.clients)]
+        try:
+            connect, connect_cpu = run_phase(agent, clients, Client.connect)
+            echo, echo_cpu = run_phase(agent, clients, lambda c: c.echo(args.keystrokes, args.typing_interval))
+            bulk, bulk_cpu = run_phase(agent, clients, lambda c: c.bulk(bulk_file.name))
+        finally:
+            for client in clients:
+                client.close()
+            agent.stop()
+            stub.stop()
+            ssh_server.stop()
+
+    echo = [latency for latencies in echo for latency in latencies]
+    total_mb = sum(r['bytes'] for r in bulk) / MB
+    session_mbps = [r['bytes'] / MB / r['seconds'] for r in bulk]
+    wall = max(r['seconds'] for r in bulk)
+
+    print(f'clients={args.clients} keystrokes={args.keystrokes} size_mb={args.size_mb} env={args.env}')
+    print('  connect latency(ms)  ' + '  '.join(f'{k}={v * 1000:.2f}' for k, v in percentiles(connect).items()))
+    print('  echo latency(ms)     ' + '  '.join(f'{k}={v * 1000:.3f}' for k, v in percentiles(echo).items()))
+    print(f'  bulk output          total={total_mb / wall:.2f}MB/s  '
+          f'per session p50={statistics.median(session_mbps):.2f}MB/s min={min(session_mbps):.2f}MB/s')
+    print(f'  agent cpu(ms/session) connect={connect_cpu * 1000:.1f}  echo={echo_cpu * 1000:.1f}  '
+          f'bulk={bulk_cpu * 1000:.1f}  bulk/MB={bulk_cpu * 1000 / args.size_mb:.2f}')
+
+
+if __name__ == '__main__':
+    main()
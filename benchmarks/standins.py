@@ -0,0 +1,171 @@
+"""
+Local stand-ins of the services the agent talks to, for benchmarks.
+
+- ``SSHServer``: paramiko based SSH server giving each shell channel a local pseudo terminal,
+  in place of the container's sshd
+- ``StubServer``: HTTP server answering the API server's token validation and the bridge
+  server's container information
+"""
+import json
+import socket
+import select
+import getpass
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import paramiko
+
+from server.utils.local_pty import LocalPtyClient
+
+BUF_SIZE = 32 * 1024
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class _ServerInterface(paramiko.ServerInterface):
+    def __init__(self, server: 'SSHServer'):
+        self.server = server
+        self.shells = {}  # channel id: LocalPtyChannel
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if username == self.server.username and password == self.server.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        self.shells[channel.get_id()] = (term, width, height)
+        return True
+
+    def check_channel_shell_request(self, channel):
+        term, width, height = self.shells.get(channel.get_id(), ('vt100', 80, 24))
+        shell = self.server.pty_client.invoke_shell(term, width, height)
+        self.shells[channel.get_id()] = shell
+        threading.Thread(target=_pump, args=(channel, shell), daemon=True).start()
+        return True
+
+    def check_channel_window_change_request(self, channel, width, height, pixelwidth, pixelheight):
+        shell = self.shells.get(channel.get_id())
+        if hasattr(shell, 'resize_pty'):
+            shell.resize_pty(width, height, pixelwidth, pixelheight)
+        return True
+
+
+def _pump(channel: paramiko.Channel, shell):
+    """ Copy bytes between the SSH channel and the shell until either is closed """
+    try:
+        while not channel.closed and not shell.closed:
+            readable, _, _ = select.select([channel, shell.fileno()], [], [], 1)
+            if channel in readable:
+                data = channel.recv(BUF_SIZE)
+                if not data:
+                    break
+                shell.sendall(data)
+            if shell.fileno() in readable:
+                try:
+                    data = shell.recv(BUF_SIZE)
+                except socket.timeout:
+                    continue
+                if not data:
+                    break
+                channel.sendall(data)
+    except OSError:
+        pass
+    finally:
+        channel.close()
+        shell.close()
+
+
+class SSHServer:
+    """ SSH server accepting ``username``/``password``, serving shells of the current OS user """
+
+    def __init__(self, username: str, password: str, port: int = 0):
+        self.username = username
+        self.password = password
+        self.port = port or free_port()
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.pty_client = LocalPtyClient(getpass.getuser())
+        self._sock = None
+
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind(('127.0.0.1', self.port))
+        self._sock.listen(128)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def stop(self):
+        self._sock.close()
+        self.pty_client.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(self.host_key)
+            transport.start_server(server=_ServerInterface(self))
+
+
+class StubServer:
+    """
+    Answer ``POST /auth/token`` with a valid token whose user id is the number at the end
+    of the token (ex. `bench-3`), and ``GET /api/containers/info`` with SSH credentials.
+    """
+
+    def __init__(self, ssh_user: str, ssh_password: str, port: int = 0):
+        self.port = port or free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        credentials = {
+            'cont_user': ssh_user,
+            'cont_auth_type': 'password',
+            'cont_auth': ssh_password,
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'] or 0)) or b'{}')
+                token = str(body.get('token', ''))
+                user_id = int(token.rsplit('-', 1)[-1]) if token[-1:].isdigit() else 0
+                self._reply({
+                    'userId': user_id,
+                    'email': f'{token}@bench',
+                    'issuedAt': '2022-04-06T09:57:03.000+00:00',
+                    'expiredAt': '2099-01-01T00:00:00.000+00:00',
+                    'valid': True,
+                })
+
+            def do_GET(self):
+                self._reply(credentials)
+
+            def _reply(self, data: dict):
+                payload = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._httpd.shutdown()
@@ -0,0 +1,96 @@
+"""
+Measure cold start of the agent process, with and without ``AGENT_LAZY_LOAD``.
+
+It reports
+- first /ping: time from spawning the process to the first successful `/ping`
+- full app: time until a route loaded lazily(`/metrics`) answers, with any status
+- import breakdown: cumulative import time of `agent` by top-level package (`python -X importtime`)
+
+Usage:
+    $ python -m benchmarks.startup
+    $ python -m benchmarks.startup --runs 10 --top 15
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+from collections import defaultdict
+from typing import Dict
+
+import requests
+
+from benchmarks.standins import free_port
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def wait_ok(url: str, deadline: float, any_status: bool = False) -> float:
+    """ Poll ``url`` until it answers 200, or anything with ``any_status``. Return the time it did. """
+    while time.perf_counter() < deadline:
+        try:
+            resp = requests.get(url, timeout=1)
+            if resp.ok or any_status:
+                return time.perf_counter()
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f'{url} did not answer')
+
+
+def measure_start(env: Dict[str, str], timeout: float = 30) -> Dict[str, float]:
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'agent:app',
+                             '--host', '127.0.0.1', '--port', str(port), '--log-level', 'warning'],
+                            cwd=REPO_DIR, env=env)
+    try:
+        deadline = start + timeout
+        ping = wait_ok(f'{url}/ping', deadline)
+        # Requires the bridge key. Lazily loaded routes answer only after loading anyway.
+        full = wait_ok(f'{url}/metrics', deadline, any_status=True)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return {'first /ping': ping - start, 'full app': full - start}
+
+
+def import_breakdown(env: Dict[str, str]) -> Dict[str, float]:
+    """ Seconds spent importing modules of each top-level package, while importing `agent` """
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import agent'],
+                            cwd=REPO_DIR, env=env, stderr=subprocess.PIPE, text=True, check=True)
+    packages = defaultdict(float)
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(own) / 1e6
+    return packages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='number of packages in the import breakdown')
+    args = parser.parse_args()
+
+    for lazy in ('true', 'false'):
+        env = dict(os.environ, AGENT_LAZY_LOAD=lazy)
+        runs = [measure_start(env) for _ in range(args.runs)]
+        imports = import_breakdown(env)
+
+        print(f'[AGENT_LAZY_LOAD={lazy}]')
+        for key in runs[0]:
+            print(f'  {key:<12} median={statistics.median(r[key] for r in runs) * 1000:.0f}ms  '
+                  f'min={min(r[key] for r in runs) * 1000:.0f}ms')
+        print(f'  import time of `agent` by package (total {sum(imports.values()) * 1000:.0f}ms)')
+        for name, seconds in sorted(imports.items(), key=lambda item: -item[1])[:args.top]:
+            print(f'    {name:<24} {seconds * 1000:7.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Compare terminal backends of ``SSHWorker``: loopback SSH and local pseudo terminal.
+
+It measures
+- echo latency: time from sending one keystroke to receiving its echo
+- bulk output: wall time and CPU time of this process per MB of shell output
+
+CPU time is the one spent by this(agent) process only. ``sshd`` CPU time is not included.
+
+Usage:
+    $ python -m benchmarks.terminal_backend --user together --password ttest
+    $ python -m benchmarks.terminal_backend --backends pty --user together
+"""
+import time
+import socket
+import select
+import argparse
+import statistics
+
+import paramiko
+
+from server.utils.local_pty import LocalPtyClient
+
+MB = 1024 * 1024
+DONE_MARKER = b'__BENCH_DONE__'
+
+
+def open_channel(backend: str, args):
+    if backend == 'pty':
+        client = LocalPtyClient(args.user)
+    else:
+        client = paramiko.SSHClient()
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
+        client.connect(hostname=args.host, port=args.port,
+                       username=args.user, password=args.password,
+                       compress=args.compress)
+
+    channel = client.invoke_shell()
+    channel.settimeout(0)
+    return client, channel
+
+
+def recv_available(channel, timeout: float) -> bytes:
+    """ Wait up to ``timeout`` seconds for output and read everything available """
+    r, _, _ = select.select([channel.fileno()], [], [], timeout)
+    if not r:
+        return b''
+
+    data = b''
+    while True:
+        try:
+            chunk = channel.recv(32 * 1024)
+        except socket.timeout:
+            return data
+        if not chunk:
+            return data
+        data += chunk
+
+
+def read_until(channel, marker: bytes, timeout: float = 60) -> int:
+    """ Read output until ``marker`` shows up. Return the number of bytes read """
+    deadline = time.monotonic() + timeout
+    tail = b''
+    total = 0
+    while True:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f'{marker!r} is not received')
+        data = recv_available(channel, 1)
+        total += len(data)
+        tail += data
+        if marker in tail:
+            return total
+        tail = tail[-len(marker):]
+
+
+def settle(channel):
+    """ Wait for the prompt and discard the login messages """
+    channel.sendall(b'echo __BENCH_""DONE__\n')
+    read_until(channel, DONE_MARKER)
+    while recv_available(channel, 0.2):
+        pass
+
+
+def bench_echo(channel, count: int):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        channel.sendall(b'x')
+        while not recv_available(channel, 1):
+            pass
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    # Clear the typed line
+    channel.sendall(b'\x15')
+    recv_available(channel, 0.2)
+
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p99': latencies[int(len(latencies) * 0.99) - 1],
+        'max': latencies[-1],
+    }
+
+
+def bench_bulk(channel, size_mb: int):
+    cmd = f'head -c {size_mb * MB} /dev/zero | tr "\\0" a; echo; echo __BENCH_""DONE__\n'
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    channel.sendall(cmd.encode())
+    received = read_until(channel, DONE_MARKER, timeout=600)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+
+    received_mb = received / MB
+    return {
+        'MB': received_mb,
+        'MB/s': received_mb / wall,
+        'cpu ms/MB': cpu * 1000 / received_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backends', default='ssh,pty', help='comma separated list of `ssh` and `pty`')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=22)
+    parser.add_argument('--user', default='together')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--compress', action='store_true', help='compress the SSH connection')
+    parser.add_argument('--keystrokes', type=int, default=200)
+    parser.add_argument('--size-mb', type=int, default=32)
+    args = parser.parse_args()
+
+    for backend in args.backends.split(','):
+        client, channel = open_channel(backend, args)
+        try:
+            settle(channel)
+            echo = bench_echo(channel, args.keystrokes)
+            bulk = bench_bulk(channel, args.size_mb)
+        finally:
+            channel.close()
+            client.close()
+
+        print(f'[{backend}]')
+        print('  echo latency(ms)  ' + '  '.join(f'{k}={v:.3f}' for k, v in echo.items()))
+        print('  bulk output       ' + '  '.join(f'{k}={v:.2f}' for k, v in bulk.items()))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 import os
-from typing import Union
+import json
+from typing import Optional, Union
 from pydantic import BaseSettings
 
 
@@ -8,13 +9,26 @@ class GlobalSettings(BaseSettings):
     BRIDGE_KEY_NAME: str = 'bridge_key'
     BRIDGE_KEY = ''  # Used to authenticate itself to bridge server
     SERVER_INIT: bool = False  # Whether it is initialized by communicating with bridge server.
-    # TODO: Make `global_settings` be synced across uvicorn processes
+    STATE_FILE_NAME: str = 'agent_state.json'  # Shares the fields above across uvicorn processes
 
 
 global_settings = GlobalSettings()
 
 
 class Settings(BaseSettings):
+    # Server related
+    AGENT_WORKERS: int = 1  # Number of uvicorn processes. Socket.io accepts websocket transport only if > 1.
+    AGENT_LAZY_LOAD: bool = True  # Load the routers other than /ping and /init after the server starts
+    METRICS_LOOP_LAG_INTERVAL: float = 0.5  # Seconds between event loop lag samples
+    STALL_CHECK_INTERVAL: float = 0.1  # Seconds between checks of the baby sitter
+    STALL_THRESHOLD: float = 0.5  # Event loop lag in seconds recorded as a stall, with the stack blocking it
+    STALL_HISTORY_SIZE: int = 50  # Number of recent stalls kept
+    PROFILE_INTERVAL: float = 0.005  # Seconds between stack samples of /debug/profile
+    PROFILE_MAX_SECONDS: float = 60  # Upper limit of the duration of /debug/profile
+    WS_COMPRESSION: bool = True  # Negotiate permessage-deflate on websocket connections
+    WS_COMPRESSION_LEVEL: int = 1  # zlib level of websocket compression. 1(fastest) ~ 9(smallest)
+    WS_COMPRESSION_THRESHOLD: int = 512  # Websocket messages smaller than this are sent uncompressed
+
     # Machine and SSH related
     AGENT_DIRECTORY: str = os.getcwd() if global_settings.DEBUG else '/usr/src/agent'
     USER_DIRECTORY: str = os.getcwd() if global_settings.DEBUG else '/usr/src/app'
@@ -22,11 +36,50 @@ class Settings(BaseSettings):
     FIXMED_PASSWORD: Union[str, bool] = 'ttest' if global_settings.DEBUG else ""
     SSH_PORT = 22
     SSH_DEFAULT_DIR = "/usr/src/app"
+    RUN_WRITE_WORKERS: int = 4  # Threads writing project files
+    RUN_SYNC: bool = True  # Write only changed files and delete removed ones, based on the manifest
+    RUN_WORKSPACE_CACHE: bool = False  # Keep a workspace per participant and link `SSH_DEFAULT_DIR` to it
+    RUN_WORKSPACE_CACHE_ADOPT: bool = False  # Move a real `SSH_DEFAULT_DIR` into the cache. Otherwise, files are downloaded into it.
+    RUN_WORKSPACE_CACHE_DIR: str = os.path.join(os.getcwd(), '.workspaces') if global_settings.DEBUG else '/usr/src/.workspaces'
+    RUN_WORKSPACE_CACHE_BYTES: int = 512 * 1024 * 1024  # Disk budget of cached workspaces
+    RUN_COMMAND: str = ''  # Shell command the RUN event executes in SSH_DEFAULT_DIR unless it gives `cmd`
+    RUN_TIMEOUT: float = 60  # Seconds a program can run before it is killed. 0 for unlimited.
+    RUN_KILL_GRACE: float = 3  # Seconds to wait after SIGTERM before SIGKILL
+    TERMINAL_BACKEND: str = 'ssh'  # `ssh`: loopback SSH connection, `pty`: local pseudo terminal
+    SSH_CONNECT_WORKERS: int = 4  # Threads running SSH handshakes and shell invocations
+    SSH_IO_WORKERS: int = 4  # Threads sending user input to SSH channels
+    SSH_COMPRESS: Optional[bool] = None  # Compress SSH connections. If unset, only to non-loopback hosts.
+    SSH_SHARE_TRANSPORT: bool = True  # Open terminals as channels of one SSH connection
+    SSH_MAX_CHANNELS_PER_TRANSPORT: int = 8  # Keep below `MaxSessions` of sshd(default 10)
+    SSH_RELAY_EVENT_DRIVEN: bool = True  # Wait for channel readiness instead of polling it
+    SSH_OUTPUT_FRAME_SIZE: int = 64 * 1024  # Maximum bytes merged into one SSH_RELAY frame
+    SSH_OUTPUT_FLUSH_INTERVAL: float = 0.01  # Time window(sec) to merge output within
+    SSH_OUTPUT_HIGH_WATER: int = 1024 * 1024  # Stop reading SSH channel when this many bytes are buffered
+    SSH_OUTPUT_MAX_PENDING: int = 16  # Hold frames while the client has this many packets queued
+    SSH_OUTPUT_RATE: int = 0  # Bytes per second relayed to each terminal. 0 for unlimited.
+    SSH_OUTPUT_BURST: int = 256 * 1024  # Bytes a terminal can relay at once beyond SSH_OUTPUT_RATE
+    SSH_OUTPUT_COLLAPSE_SIZE: int = 256 * 1024  # Skip the middle of output buffered beyond this while the client is behind. 0 to disable.
+    SSH_WORKER_TTL: int = 30 * 60  # Seconds to keep a disconnected terminal for reconnection
+    SSH_MAX_WORKERS: int = 100  # Terminals kept in this container. Least recently used one is evicted.
+    SSH_REAPER_INTERVAL: int = 30  # Seconds between idle terminal checks
+    SSH_SCROLLBACK_SIZE: int = 64 * 1024  # Bytes of recent output replayed on reconnection. 0 to disable.
+    SSH_WARM_WORKERS: int = 2  # Shells kept started for the next SSH_CONNECT. 0 to disable.
+    SSH_RECORD: bool = False  # Record output of terminals, for grading and debugging
+    SSH_RECORD_DIR: str = os.path.join(os.getcwd(), '.recordings') if global_settings.DEBUG else '/usr/src/.recordings'
+    SSH_RECORD_SEGMENT_SIZE: int = 8 * 1024 * 1024  # Bytes of a recording file before rotating to the next
+    SSH_RECORD_MAX_SIZE: int = 256 * 1024 * 1024  # Disk budget of recordings. Oldest files are deleted.
+    SSH_RECORD_FLUSH_INTERVAL: float = 1  # Seconds output is buffered in memory before written
+    SSH_RECORD_INDEX_INTERVAL: float = 1  # Seconds of output between index entries used to seek
 
     # API related
     API_URL = 'https://api.together-coding.com'
     BRIDGE_URL = 'http://localhost:8080' if global_settings.DEBUG else 'https://bridge.together-coding.com'
     WS_URL = 'https://ide-ws.together-coding.com'
+    BRIDGE_CACHE_TTL: int = 10 * 60  # Seconds until cached SSH credentials are refreshed in the background
+    HTTP_WORKERS: int = 8  # Threads (and pooled connections per host) for outgoing HTTP requests
+    HTTP_TIMEOUT: float = 5  # Seconds to connect or to wait for a response
+    AUTH_CACHE_TTL: int = 5 * 60  # Seconds to trust a validated token. Never longer than its expiry.
+    AUTH_CACHE_SIZE: int = 1024  # Maximum number of validated tokens cached
 
 
 settings = Settings()
@@ -39,3 +92,54 @@ def read_bridge_key():
             global_settings.BRIDGE_KEY = fp.read()
     else:
         global_settings.BRIDGE_KEY = ''
+
+
+_state_mtime = None  # Last modification time of the state file loaded
+
+
+def save_global_settings():
+    """ Share initialization state with the other processes """
+    if settings.AGENT_WORKERS <= 1:
+        return
+
+    state = {
+        'SERVER_INIT': global_settings.SERVER_INIT,
+        'BRIDGE_KEY': global_settings.BRIDGE_KEY,
+    }
+    tmp = f'{global_settings.STATE_FILE_NAME}.{os.getpid()}.tmp'
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'wt') as fp:
+        json.dump(state, fp)
+    os.replace(tmp, global_settings.STATE_FILE_NAME)
+
+
+def reset_global_settings():
+    """ Delete the state left by the previous run, before the worker processes start. It must be initialized again. """
+    try:
+        os.unlink(global_settings.STATE_FILE_NAME)
+    except FileNotFoundError:
+        pass
+
+
+def sync_global_settings():
+    """
+    Load initialization state if another process has changed it.
+    It costs a ``stat`` call when nothing has changed.
+    """
+    global _state_mtime
+
+    if settings.AGENT_WORKERS <= 1:
+        return
+
+    try:
+        mtime = os.stat(global_settings.STATE_FILE_NAME).st_mtime_ns
+        if mtime == _state_mtime:
+            return
+        with open(global_settings.STATE_FILE_NAME, 'rt') as fp:
+            state = json.load(fp)
+    except (OSError, ValueError):
+        return
+
+    _state_mtime = mtime
+    global_settings.SERVER_INIT = bool(state.get('SERVER_INIT'))
+    global_settings.BRIDGE_KEY = state.get('BRIDGE_KEY') or ''
@@ -1,14 +1,13 @@
 import importlib
+import threading
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from configs import global_settings
+from configs import settings, global_settings
 from server import routers
-from server.websocket import create_websocket
 
 app = FastAPI()
-sio, sio_app = create_websocket(app)
 
 origins = ['*']
 
@@ -21,6 +20,46 @@ app.add_middleware(
     allow_headers=['X-API-KEY', 'Authorization']
 )
 
-for router_mod in routers.__all__:
-    router = importlib.import_module(f'.routers.{router_mod}', package=__name__)
-    app.include_router(router.router)
+# Routers served before the others are loaded with ``settings.AGENT_LAZY_LOAD``
+EAGER_ROUTERS = ['main']
+EAGER_PATHS = ['/ping', '/init']
+
+_websocket = None  # (sio, sio_app) once created
+_websocket_lock = threading.Lock()  # The loader thread and the others can create it at once
+
+
+def create_websocket():
+    """ Create the socket.io server unless it is created """
+    global _websocket
+
+    if _websocket is None:
+        with _websocket_lock:
+            if _websocket is None:
+                from server.websocket import create_websocket
+                _websocket = create_websocket(app)
+    return _websocket
+
+
+def __getattr__(name):
+    # ``sio`` is created by the first module importing it
+    if name == 'sio':
+        return create_websocket()[0]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+if settings.AGENT_LAZY_LOAD:
+    from server.lazy import LazyApp
+
+    for router_mod in EAGER_ROUTERS:
+        router = importlib.import_module(f'.routers.{router_mod}', package=__name__)
+        app.include_router(router.router)
+
+    sio_app = LazyApp(app, EAGER_PATHS,
+                      [mod for mod in routers.__all__ if mod not in EAGER_ROUTERS],
+                      lambda: create_websocket()[1])
+else:
+    sio_app = create_websocket()[1]
+
+    for router_mod in routers.__all__:
+        router = importlib.import_module(f'.routers.{router_mod}', package=__name__)
+        app.include_router(router.router)
@@ -0,0 +1,77 @@
+import asyncio
+import importlib
+from typing import Callable, List, Optional
+
+from fastapi import APIRouter, FastAPI
+
+
+class LazyApp:
+    """
+    ASGI app for ``settings.AGENT_LAZY_LOAD``.
+
+    Only the routers included in ``app`` beforehand(``/ping``, ``/init``) are served at first.
+    The other routers, the socket.io server and the SSH stack they import are loaded in a
+    thread once the server starts, so the event loop keeps answering meanwhile. Requests
+    for the others wait until the loading is done.
+    """
+
+    def __init__(self, app: FastAPI, eager_paths: List[str], router_mods: List[str],
+                 create_asgi_app: Callable[[], Callable]):
+        """
+        :param eager_paths: paths served before loading is done
+        :param router_mods: modules of ``server.routers`` to load
+        :param create_asgi_app: function returning the ASGI app serving ``app`` and socket.io
+        """
+        self.app = app
+        self.eager_paths = set(eager_paths)
+        self.router_mods = router_mods
+        self.create_asgi_app = create_asgi_app
+
+        self._target: Optional[Callable] = None  # ASGI app after loading
+        self._loading: Optional[asyncio.Task] = None
+        app.add_event_handler('startup', self.start_loading)
+
+    async def __call__(self, scope, receive, send):
+        if self._target is not None:
+            return await self._target(scope, receive, send)
+
+        if scope['type'] == 'lifespan' or scope['path'] in self.eager_paths:
+            return await self.app(scope, receive, send)
+
+        await self.load()
+        await self._target(scope, receive, send)
+
+    def start_loading(self) -> asyncio.Task:
+        """ Start loading the other routers in the background unless it is started """
+
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(self._load())
+        return self._loading
+
+    async def load(self):
+        """ Wait until the other routers are loaded """
+        await asyncio.shield(self.start_loading())
+
+    async def _load(self):
+        loop = asyncio.get_running_loop()
+        target, routers = await loop.run_in_executor(None, self._import)
+
+        for router in routers:
+            self.app.include_router(router)
+            # Startup of the app is over. Run the handlers of the routers by themselves.
+            for handler in router.on_startup:
+                if asyncio.iscoroutinefunction(handler):
+                    await handler()
+                else:
+                    handler()
+        self._target = target
+
+    def _import(self):
+        """ Blocking part of loading """
+
+        target = self.create_asgi_app()
+        routers: List[APIRouter] = []
+        for router_mod in self.router_mods:
+            module = importlib.import_module(f'server.routers.{router_mod}')
+            routers.append(module.router)
+        return target, routers
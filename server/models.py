@@ -1,5 +1,6 @@
 import hashlib
 from dataclasses import dataclass
+from functools import cached_property
 
 
 @dataclass
@@ -7,7 +8,7 @@ class User:
     user_id: int
     ip: str
 
-    @property
+    @cached_property
     def key(self):
         md5 = hashlib.md5()
         md5.update(f'{self.user_id}{self.ip}'.encode())
@@ -22,7 +23,7 @@ class ConnectionInfo:
     ssh_user: str
     port: int
 
-    @property
+    @cached_property
     def key(self):
         md5 = hashlib.md5()
         md5.update(f'{self.user.key}{self.src}{self.dest}{self.ssh_user}{self.port}'.encode())
@@ -2,4 +2,6 @@ __all__ = [
     'main',
     'ssh',
     'run',
+    'metrics',
+    'debug',
 ]
@@ -0,0 +1,32 @@
+from fastapi import APIRouter, Depends, HTTPException
+
+import baby_sitter
+from server.utils.auth import bridge_only
+from server.utils.etc import run_blocking
+from server.utils.response import api_response
+
+router = APIRouter(prefix='/debug', dependencies=[Depends(bridge_only)])
+
+
+@router.on_event('startup')
+async def startup():
+    baby_sitter.run()
+
+
+@router.get('/stalls')
+def get_stalls():
+    """ Recent event loop stalls and the stacks blocking them """
+    return api_response(list(baby_sitter.stalls))
+
+
+@router.get('/profile')
+async def get_profile(seconds: float = 5, top: int = 20):
+    """ Sample stacks of the event loop for ``seconds`` and return the most frequent ones """
+    try:
+        result = await run_blocking(None, baby_sitter.profile, seconds, top)
+    except RuntimeError as e:
+        raise HTTPException(
+            status_code=409,
+            detail={'type': 'Profile Error', 'msg': str(e)}
+        )
+    return api_response(result)
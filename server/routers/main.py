@@ -1,8 +1,8 @@
-from fastapi import APIRouter, Depends, dependencies, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, dependencies, HTTPException
 from pydantic import BaseModel
 
-from configs import settings, global_settings, read_bridge_key
-from server.utils import os_util
+from configs import settings, global_settings, read_bridge_key, save_global_settings, sync_global_settings
+from server.utils import os_util, bridge
 from server.utils.response import api_response
 from server.utils.auth import bridge_only
 
@@ -11,6 +11,7 @@ router = APIRouter()
 
 @router.get('/ping')
 def pong():
+    sync_global_settings()
     return api_response({
         'ping': 'pong',
         'init': global_settings.SERVER_INIT,
@@ -23,13 +24,14 @@ class InitBody(BaseModel):
 
 
 @router.post('/init')
-def init_server(body: InitBody):
+def init_server(body: InitBody, background_tasks: BackgroundTasks):
     """
     Initialize server at the first time this server is up.
     The Runtime Bridge server will call this path.
     """
 
     # If already initialized, return error
+    sync_global_settings()
     if global_settings.SERVER_INIT is True:
         raise HTTPException(
             status_code=400,
@@ -46,12 +48,31 @@ def init_server(body: InitBody):
 
     # Change user password randomly.
     pw = os_util.change_password()
+    if pw is None:
+        bridge.invalidate_credentials()
+    else:
+        bridge.set_credentials(settings.USERNAME, 'password', pw)
+        # Start shells for the first users, after responding
+        background_tasks.add_task(start_shells, pw)
 
     # Set as initialized
     global_settings.SERVER_INIT = True
+    save_global_settings()
 
     return api_response({
         'username': settings.USERNAME,
         'auth_type': 'password',
         'auth': pw
     })
+
+
+async def start_shells(password: str):
+    """ Fill the warm pool of shells once the SSH stack is loaded """
+
+    if settings.AGENT_LAZY_LOAD:
+        from server import sio_app
+        await sio_app.load()
+
+    # Loaded already. Importing it at the top would load it before ``/init`` with ``settings.AGENT_LAZY_LOAD``.
+    from server.utils.ssh import warm_up
+    await warm_up('127.0.0.1', settings.USERNAME, password, settings.SSH_PORT)
@@ -0,0 +1,29 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+from server.utils import metrics
+from server.utils.auth import bridge_only
+from server.utils.ssh import worker_counts, viewer_count, transport_pool, warm_pool
+
+router = APIRouter()
+
+for _status in ('connected', 'disconnected'):
+    metrics.Gauge('agent_ssh_workers', 'SSH workers alive',
+                  lambda status=_status: worker_counts()[status], {'status': _status})
+for _reason in ('reaped', 'evicted'):
+    metrics.CounterFunc('agent_ssh_workers_destructed_total', 'SSH workers destructed by the reaper',
+                        lambda reason=_reason: worker_counts()[reason], {'reason': _reason})
+metrics.Gauge('agent_ssh_transports', 'SSH connections shared by workers', lambda: len(transport_pool))
+metrics.Gauge('agent_ssh_viewers', 'Clients watching terminals read-only', viewer_count)
+metrics.Gauge('agent_ssh_warm_workers', 'Shells started for the next SSH_CONNECT', lambda: len(warm_pool))
+
+
+@router.on_event('startup')
+async def startup():
+    metrics.start_loop_monitor()
+
+
+@router.get('/metrics', dependencies=[Depends(bridge_only)])
+def get_metrics():
+    """ Metrics in the Prometheus text format. Scrapers send the bridge key as ``X-API-KEY``. """
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
@@ -1,16 +1,43 @@
 import os
-import requests
-from fastapi.responses import PlainTextResponse
-from fastapi import APIRouter, Depends, Header, dependencies, HTTPException
+import fcntl
+import threading
+from contextlib import contextmanager
+
+from fastapi import APIRouter, Header, HTTPException
 from pydantic import BaseModel
 
-from configs import settings, global_settings, read_bridge_key
-from server.utils import os_util
+from configs import settings
+from server import sio
+from server.routers.ssh import ws_auth_required, server_init_required
+from server.utils import http_client
 from server.utils.response import api_response
-from server.utils.auth import bridge_only
+from server.utils.runner import ProgramRunner, runners
+from server.utils.workspace import JsonObjectStream, Manifest, WorkspaceWriter, WorkspaceCache
+from server.websocket import InEvent, OutEvent, ErrorType
 
 router = APIRouter(prefix="/run")
 
+CHUNK_SIZE = 64 * 1024
+
+workspace_cache = WorkspaceCache(settings.SSH_DEFAULT_DIR,
+                                 settings.RUN_WORKSPACE_CACHE_DIR,
+                                 settings.RUN_WORKSPACE_CACHE_BYTES,
+                                 settings.RUN_WORKSPACE_CACHE_ADOPT)
+_run_lock = threading.Lock()
+RUN_LOCK_FILE = os.path.join(settings.AGENT_DIRECTORY, '.run.lock')
+
+
+@contextmanager
+def run_lock():
+    """ One download at a time not to mix up workspaces, across uvicorn processes too(``AGENT_WORKERS``) """
+
+    with _run_lock, open(RUN_LOCK_FILE, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
 
 class StartBody(BaseModel):
     target_ptc_id: int
@@ -20,38 +47,132 @@ class StartBody(BaseModel):
 
 @router.post('/start')
 def start_run(body: StartBody, auth: str = Header(alias='Authorization', default='')):
+    """
+    Download project files into ``settings.SSH_DEFAULT_DIR``.
+    Files are written while the response is being downloaded.
+
+    With ``settings.RUN_SYNC``, hashes of the files written last time are sent as
+    ``manifest``. The IDE server may answer ``null`` for the files of the same hash,
+    and files missing in the response are deleted.
+
+    With ``settings.RUN_WORKSPACE_CACHE``, each participant has its own workspace and
+    ``settings.SSH_DEFAULT_DIR`` is switched to it after it is downloaded. Open terminals
+    must ``cd`` again to see it.
+    """
+    with run_lock():
+        if settings.RUN_WORKSPACE_CACHE and workspace_cache.prepare():
+            stats = download(body, auth, workspace_cache.path_of(body.target_ptc_id))
+            workspace_cache.activate(body.target_ptc_id)
+            workspace_cache.evict()
+        else:
+            stats = download(body, auth, settings.SSH_DEFAULT_DIR)
+
+    return api_response(stats)
+
+
+def download(body: StartBody, auth: str, root: str) -> dict:
+    """ Download project files into ``root`` """
+
     headers = {
         'Authorization': auth
     }
-    
-    url = settings.WS_URL + f"/api/{body.course_id}/{body.lesson_id}/{body.target_ptc_id}"
-    resp = requests.post(url, json={
+    manifest = Manifest.of(root) if settings.RUN_SYNC else None
+    payload = {
         'target_ptc_id': body.target_ptc_id,
-    }, headers=headers)
-
-    files = resp.json()
-    print(files)
-
-    DIR = settings.SSH_DEFAULT_DIR
-    if not os.path.exists(DIR):
-        os.mkdir(DIR)
-
-    for f, content in files.items():
-        if not f:
-            continue
-
-        dir = os.path.dirname(f)
-        
-        for _ in range(2):
-            try:
-                with open(os.path.join(DIR, f), 'wt') as fp:
-                    fp.write(content)
-                break
-            except (FileNotFoundError, FileExistsError):
-                if not os.path.exists(os.path.join(DIR, f)):
-                    os.makedirs(os.path.join(DIR, dir))
-
-    uname = settings.USERNAME
-    os.system(f'chown -R {uname}:{uname} {DIR}')
-
-    return PlainTextResponse(str(files))
+    }
+    if manifest:
+        payload['manifest'] = manifest.hashes()
+
+    url = settings.WS_URL + f"/api/{body.course_id}/{body.lesson_id}/{body.target_ptc_id}"
+    with http_client.session.post(url, json=payload, headers=headers,
+                                  stream=True, timeout=settings.HTTP_TIMEOUT) as resp:
+        if not resp.ok:
+            raise HTTPException(
+                status_code=resp.status_code,
+                detail={'type': 'Download Error', 'msg': 'Failed to download project files.'}
+            )
+
+        writer = WorkspaceWriter(root, settings.USERNAME, manifest)
+        try:
+            for f, content in JsonObjectStream(resp.iter_content(CHUNK_SIZE)):
+                if not f:
+                    continue
+                writer.submit(f, content)
+            return writer.finish()
+        except ValueError as e:
+            # Do not delete files with the broken response or an invalid path
+            writer.finish(delete=False)
+            raise HTTPException(
+                status_code=400,
+                detail={'type': 'Download Error', 'msg': str(e)}
+            )
+
+
+@sio.on(InEvent.RUN)
+@ws_auth_required
+@server_init_required
+async def run_program(sid, data=None):
+    """
+    Execute ``data['cmd']``, or ``settings.RUN_COMMAND`` without it, and stream its output.
+    ``data['timeout']`` can shorten ``settings.RUN_TIMEOUT``.
+    """
+    data = data or {}
+    if not isinstance(data, dict):
+        return await emit_invalid(sid, 'RUN takes an object')
+
+    cmd = data.get('cmd') or settings.RUN_COMMAND
+    timeout = data.get('timeout')
+    if not cmd:
+        await sio.emit(OutEvent.ERROR,
+                       {'type': ErrorType.MISSING_FIELD, 'message': '`cmd` is missing'},
+                       room=sid)
+        return
+    if not isinstance(cmd, str):
+        return await emit_invalid(sid, '`cmd` must be a string')
+    if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float))
+                                or timeout <= 0):
+        return await emit_invalid(sid, '`timeout` must be a positive number')
+    if sid in runners:
+        await sio.emit(OutEvent.ERROR,
+                       {'type': ErrorType.COMMON, 'message': 'A program is already running'},
+                       room=sid)
+        return
+
+    if timeout is None:
+        timeout = settings.RUN_TIMEOUT
+    else:
+        timeout = min(timeout, settings.RUN_TIMEOUT or float('inf'))
+
+    runner = ProgramRunner(sid, cmd, timeout)
+    runners[sid] = runner
+    try:
+        await runner.run()
+    except OSError as e:
+        await sio.emit(OutEvent.ERROR,
+                       {'type': ErrorType.COMMON, 'message': f'Failed to run the program: {e}'},
+                       room=sid)
+    finally:
+        runners.pop(sid, None)
+
+
+@sio.on(InEvent.RUN_STDIN)
+@ws_auth_required
+async def write_to_program(sid, data=None):
+    if not isinstance(data, (str, type(None))):
+        return await emit_invalid(sid, 'RUN_STDIN takes a string or null')
+
+    runner = runners.get(sid)
+    if runner:
+        await runner.write(data)
+
+
+@sio.on(InEvent.RUN_CANCEL)
+@ws_auth_required
+async def cancel_program(sid, data=None):
+    runner = runners.get(sid)
+    if runner:
+        await runner.cancel()
+
+
+async def emit_invalid(sid: str, message: str):
+    await sio.emit(OutEvent.ERROR, {'type': ErrorType.INVALID_FIELD, 'message': message}, room=sid)
@@ -1,18 +1,77 @@
+import base64
 import functools
+from typing import Dict, Optional
 
 import requests
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, HTTPException
 
-from configs import settings, global_settings
+from configs import settings, global_settings, sync_global_settings
 from server import sio
-from server.utils import ws_session
+from server.utils import ws_session, bridge
+from server.utils.auth import bridge_only, verify_token
+from server.utils.response import api_response
 from server.websocket import InEvent, OutEvent, ErrorType
 from server.models import User
-from server.utils.ssh import ssh_connect, SSHWorker, Reason
-from server.utils.exceptions import SSHConnectionException
+from server.utils.ssh import ssh_connect, ssh_workers, SSHWorker, Reason, start_reaper, worker_counts
+from server.utils.runner import cancel_run
+from server.utils.recorder import list_recordings, read_recording
+from server.utils.exceptions import SSHConnectionException, BridgeException
 
 router = APIRouter(prefix='/ssh')
 
+# sid: worker of the authorized and connected client. Keystrokes of bound clients skip
+# the authorization and session lookups. Unbound on re-authentication and disconnection.
+bindings: Dict[str, SSHWorker] = {}
+
+
+@router.on_event('startup')
+async def startup():
+    start_reaper()
+
+
+@router.get('/workers', dependencies=[Depends(bridge_only)])
+def get_workers():
+    """ Number of SSH workers alive and destructed by the reaper """
+    return api_response(worker_counts())
+
+
+@router.get('/workers/{user_id}/watch', dependencies=[Depends(bridge_only)])
+def get_watch_tokens(user_id: int):
+    """ Tokens to watch the terminals of the user by SSH_WATCH """
+    return api_response({'tokens': [worker.watch_token for worker in ssh_workers.of_user(user_id)]})
+
+
+@router.get('/recordings', dependencies=[Depends(bridge_only)])
+def get_recordings(user_id: Optional[int] = None):
+    """ Recordings of terminal output(``settings.SSH_RECORD``), of ``user_id`` if given """
+    return api_response({'recordings': list_recordings(user_id)})
+
+
+@router.get('/recordings/{name}', dependencies=[Depends(bridge_only)])
+def play_recording(name: str, since: float = 0, until: Optional[float] = None, max_bytes: int = 1024 * 1024,
+                   cursor: Optional[str] = None):
+    """
+    Output recorded from ``since`` to ``until``(epoch seconds) as [time, base64 of output] pairs.
+    If there is more than ``max_bytes``, ``next`` is the ``cursor`` to continue from.
+    """
+    try:
+        chunks, next_cursor = read_recording(name, since, until, max_bytes, cursor)
+    except FileNotFoundError:
+        raise HTTPException(
+            status_code=404,
+            detail={'type': 'Recording Error', 'msg': 'No such recording.'}
+        )
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail={'type': 'Recording Error', 'msg': 'Invalid cursor.'}
+        )
+
+    return api_response({
+        'chunks': [[at, base64.b64encode(data).decode()] for at, data in chunks],
+        'next': next_cursor,
+    })
+
 
 def server_init_required(func):
     """
@@ -20,7 +79,8 @@ def server_init_required(func):
     Initialization is done by main.init_server at its startup.
     """
     @functools.wraps(func)
-    async def decorated(sid, data):
+    async def decorated(sid, data=None):
+        sync_global_settings()
         if not global_settings.SERVER_INIT or not global_settings.BRIDGE_KEY:
             await sio.emit(OutEvent.ERROR,
                            {'type': ErrorType.INIT_NEEDED,
@@ -34,7 +94,7 @@ def server_init_required(func):
 
 def ws_auth_required(func):
     @functools.wraps(func)
-    async def decorated(sid, data):
+    async def decorated(sid, data=None):
         if not (await is_valid(sid)):
             await sio.emit(OutEvent.ERROR,
                            {'type': ErrorType.AUTH, 'message': 'Not authorized'},
@@ -58,16 +118,26 @@ async def connect(sid, environ, auth):
 
 @sio.event
 async def disconnect(sid):
-    """ Cleanup ssh worker """
+    """ Cleanup ssh worker, the running program and the watching """
+    await cancel_run(sid)
+    await unwatch_ssh(sid)
+    await detach(sid, Reason.WS_DISCONNECTED)
+
+
+async def detach(sid, reason: str):
+    """ Stop relaying the ssh worker of ``sid`` and unbind it """
+
+    bindings.pop(sid, None)
     ssh_worker: SSHWorker = await ws_session.get(sid, 'ssh')
     if ssh_worker:
-        reason = Reason.WS_DISCONNECTED
         ssh_worker.stop_tasks(reason)
         await ssh_worker.cleanup(reason, False)
+        await ws_session.update(sid, {'ssh': None})
 
 
 @sio.on(InEvent.AUTHENTICATE)
 async def authenticate(sid, data):
+    bindings.pop(sid, None)
     token = data.get('token')
 
     if not token:
@@ -77,22 +147,8 @@ async def authenticate(sid, data):
         return
 
     try:
-        resp = requests.post(settings.API_URL + '/auth/token', json={
-            'token': token
-        })
-        resp.raise_for_status()
-
-        """
-        {
-            'userId': 1,
-            'email': '...', 
-            'issuedAt': '2022-04-06T09:57:03.000+00:00', 
-            'expiredAt': '2022-05-06T09:57:03.000+00:00', 
-            'valid': True
-        }
-        """
-        resp_data = resp.json()
-    except requests.HTTPError:
+        resp_data = await verify_token(token)
+    except requests.RequestException:
         await sio.emit(OutEvent.ERROR,
                        {'type': ErrorType.COMMON, 'message': 'Try again later'},
                        room=sid)
@@ -117,22 +173,14 @@ async def connect_to_ssh(sid, data=None):
     s = await sio.get_session(sid)
     user = User(user_id=s['userId'], ip=s['ip'])
 
-    headers = {'X-API-KEY': global_settings.BRIDGE_KEY}
-    resp = requests.get(settings.BRIDGE_URL + f'/api/containers/info',
-                        headers=headers)
-
-    if not resp.ok:
-        # TODO: send sentry
-        try:
-            reason = resp.json()['error']
-        except:
-            reason = f'Bridge is dead. ({resp.status_code})'
+    try:
+        resp = await bridge.get_credentials()
+    except BridgeException as e:
         await sio.emit(OutEvent.ERROR,
-                       {'type': ErrorType.UNKNOWN, 'message': reason},
+                       {'type': ErrorType.UNKNOWN, 'message': str(e)},
                        room=sid)
         return
 
-    resp = resp.json()
     ssh_data = {
         'cont_ip': '127.0.0.1',  # Fixed value
         'cont_user': resp['cont_user'],
@@ -141,19 +189,40 @@ async def connect_to_ssh(sid, data=None):
         'cont_port': settings.SSH_PORT,  # Fixed value for now
     }
 
+    resume = data.get('resume') if isinstance(data, dict) else None
+    if resume:
+        # The terminal can be still open in another window, ex. the one before the network
+        # changed. Take it over.
+        previous = ssh_workers.by_token(resume, user.user_id)
+        if previous is not None and previous.is_connected and previous.sid != sid:
+            # Only the old window is told. The terminal keeps running for the viewers.
+            previous_sid = previous.sid
+            await detach(previous_sid, Reason.SSH_RESUMED)
+            await sio.emit(OutEvent.SSH_DOWN,
+                           {'type': 'ssh closed', 'message': Reason.SSH_RESUMED},
+                           room=previous_sid)
+
     try:
-        ssh_worker = ssh_connect(sio,
-                                 user,
-                                 ssh_data['cont_ip'],
-                                 ssh_data['cont_user'],
-                                 ssh_data['cont_auth_type'],
-                                 ssh_data['cont_auth'],
-                                 ssh_data['cont_port'])
+        ssh_worker = await ssh_connect(sid,
+                                       user,
+                                       ssh_data['cont_ip'],
+                                       ssh_data['cont_user'],
+                                       ssh_data['cont_auth_type'],
+                                       ssh_data['cont_auth'],
+                                       ssh_data['cont_port'],
+                                       resume=resume)
         ssh_worker.sio_accepted(sid)
         await ws_session.update(sid, {'ssh': ssh_worker})
+        bindings[sid] = ssh_worker
+        await sio.emit(OutEvent.SSH_RESUME,
+                       {'token': ssh_workers.token(ssh_worker), 'watch': ssh_worker.watch_token},
+                       room=sid)
         return await ssh_worker.run()
     except SSHConnectionException as e:
         message = str(e)
+        if message == Reason.SSH_AUTH_FAIL:
+            # Password might be changed. Ask bridge server next time.
+            bridge.invalidate_credentials()
     except:
         message = Reason.SSH_FAIL
 
@@ -163,14 +232,61 @@ async def connect_to_ssh(sid, data=None):
 
 
 @sio.on(InEvent.SSH)
-@ws_auth_required
 async def recv_from_client(sid, data):
-    ssh_worker: SSHWorker = await ws_session.get(sid, 'ssh')
+    ssh_worker = bindings.get(sid)
+    if ssh_worker is None:
+        return await recv_from_unbound_client(sid, data)
     await ssh_worker.recv_from_client(data)
-    
 
-@sio.on(InEvent.SSH_RESIZE)
+
 @ws_auth_required
-async def resize_pty(sid, data):
+async def recv_from_unbound_client(sid, data):
     ssh_worker: SSHWorker = await ws_session.get(sid, 'ssh')
+    if ssh_worker:
+        await ssh_worker.recv_from_client(data)
+
+
+@sio.on(InEvent.SSH_RESIZE)
+async def resize_pty(sid, data):
+    ssh_worker = bindings.get(sid)
+    if ssh_worker is None:
+        return await resize_unbound_pty(sid, data)
     ssh_worker.resize_pty(data['cols'], data['rows'])
+
+
+@ws_auth_required
+async def resize_unbound_pty(sid, data):
+    ssh_worker: SSHWorker = await ws_session.get(sid, 'ssh')
+    if ssh_worker:
+        ssh_worker.resize_pty(data['cols'], data['rows'])
+
+
+@sio.on(InEvent.SSH_WATCH)
+@ws_auth_required
+@server_init_required
+async def watch_ssh(sid, data=None):
+    """ Receive the output of another terminal read-only, as SSH_WATCH_RELAY """
+
+    token = data.get('token') if isinstance(data, dict) else None
+    ssh_worker = ssh_workers.by_watch_token(token) if token else None
+    if ssh_worker is None:
+        await sio.emit(OutEvent.ERROR,
+                       {'type': ErrorType.SSH, 'message': Reason.SSH_NOT_FOUND},
+                       room=sid)
+        return
+
+    await unwatch_ssh(sid)
+    # Show the current screen, then the output from now on
+    screen = ssh_worker.replay_data()
+    ssh_worker.viewers.join(sid)
+    await ws_session.update(sid, {'watch': ssh_worker})
+    if screen:
+        await sio.emit(OutEvent.SSH_WATCH_RELAY, screen, room=sid)
+
+
+@sio.on(InEvent.SSH_UNWATCH)
+async def unwatch_ssh(sid, data=None):
+    ssh_worker: SSHWorker = await ws_session.get(sid, 'watch')
+    if ssh_worker:
+        ssh_worker.viewers.leave(sid)
+        await ws_session.update(sid, {'watch': None})
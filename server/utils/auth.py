@@ -1,8 +1,16 @@
-from typing import Optional
+import time
+import asyncio
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
 
 from fastapi import Header, HTTPException
 
-from configs import global_settings
+from configs import settings, global_settings, save_global_settings, sync_global_settings
+from server.utils import http_client, metrics
+
+# token: (monotonic time to expire, response of API server)
+_token_cache: Dict[str, Tuple[float, dict]] = {}
+_token_requests: Dict[str, asyncio.Task] = {}  # token: in-flight validation
 
 
 async def bridge_only(api_key: Optional[str] = Header(None, alias='X-API-KEY')):
@@ -14,6 +22,7 @@ async def bridge_only(api_key: Optional[str] = Header(None, alias='X-API-KEY')):
     api key is in header `X-API-KEY`, and the api key is same with `BRIDGE_KEY`,
     then the request is authorized.
     """
+    sync_global_settings()
     if not global_settings.SERVER_INIT:
         # Server is not initialized.
         raise HTTPException(
@@ -23,6 +32,7 @@ async def bridge_only(api_key: Optional[str] = Header(None, alias='X-API-KEY')):
     elif not global_settings.BRIDGE_KEY:
         # Bridge key is empty
         global_settings.SERVER_INIT = False
+        save_global_settings()
         raise HTTPException(
             status_code=400,
             detail={'type': 'Init Error', 'msg': 'Server needs to be re-initialized.'}
@@ -38,4 +48,74 @@ async def bridge_only(api_key: Optional[str] = Header(None, alias='X-API-KEY')):
         raise HTTPException(
             status_code=401,
             detail={'type': 'Authorization Failed', 'msg': 'Not authorized key'}
-        )
\ No newline at end of file
+        )
+
+
+async def verify_token(token: str) -> dict:
+    """
+    Validate ``token`` with the API server, and return its response like below.
+    {
+        'userId': 1,
+        'email': '...',
+        'issuedAt': '2022-04-06T09:57:03.000+00:00',
+        'expiredAt': '2022-05-06T09:57:03.000+00:00',
+        'valid': True
+    }
+
+    Valid tokens are cached for ``settings.AUTH_CACHE_TTL`` seconds, but never past
+    their ``expiredAt``. Concurrent validations of the same token share one request.
+
+    :raise requests.RequestException: API server is not available
+    """
+
+    cached = _token_cache.get(token)
+    if cached:
+        expires, data = cached
+        if expires > time.monotonic():
+            return dict(data)
+        del _token_cache[token]
+
+    task = _token_requests.get(token)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_token(token))
+        task.add_done_callback(lambda _: _token_requests.pop(token, None))
+        _token_requests[token] = task
+
+    return dict(await asyncio.shield(task))
+
+
+async def _fetch_token(token: str) -> dict:
+    start = time.perf_counter()
+    try:
+        resp = await http_client.post(settings.API_URL + '/auth/token', json={
+            'token': token
+        })
+    finally:
+        metrics.auth_request.observe(time.perf_counter() - start)
+    resp.raise_for_status()
+    data = resp.json()
+
+    ttl = _token_ttl(data)
+    if ttl > 0:
+        while len(_token_cache) >= settings.AUTH_CACHE_SIZE:
+            # Drop the oldest one
+            del _token_cache[next(iter(_token_cache))]
+        _token_cache[token] = (time.monotonic() + ttl, data)
+    return data
+
+
+def _token_ttl(data: dict) -> float:
+    """ Seconds to cache the validation result. 0 if it must not be cached. """
+
+    if not data.get('valid'):
+        return 0
+
+    try:
+        expired_at = datetime.fromisoformat(data['expiredAt'])
+    except (KeyError, TypeError, ValueError):
+        return 0
+    if expired_at.tzinfo is None:
+        expired_at = expired_at.replace(tzinfo=timezone.utc)
+
+    remains = (expired_at - datetime.now(timezone.utc)).total_seconds()
+    return max(0, min(settings.AUTH_CACHE_TTL, remains))
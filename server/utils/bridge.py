@@ -0,0 +1,91 @@
+import time
+import asyncio
+from typing import Optional
+
+import requests
+
+from configs import settings, global_settings
+from server.utils import http_client, metrics
+from server.utils.exceptions import BridgeException
+
+# SSH credentials of this container. They only change when the server is initialized.
+_credentials: Optional[dict] = None
+_fetched_at = 0.0
+_fetching: Optional[asyncio.Task] = None
+
+
+def set_credentials(username: str, auth_type: str, auth: str) -> dict:
+    """ Cache credentials, which is known by the server itself on initialization """
+    global _credentials, _fetched_at
+
+    _credentials = {
+        'cont_user': username,
+        'cont_auth_type': auth_type,
+        'cont_auth': auth,
+    }
+    _fetched_at = time.monotonic()
+    return _credentials
+
+
+def invalidate_credentials():
+    """ Forget cached credentials. The next call of ``get_credentials`` asks bridge server. """
+    global _credentials
+
+    _credentials = None
+
+
+async def get_credentials() -> dict:
+    """
+    Return SSH credentials of this container.
+    Credentials are fetched from the bridge server only when they are not cached.
+    Once cached ones are older than ``settings.BRIDGE_CACHE_TTL``, they are refreshed
+    in the background while the cached ones are still returned.
+
+    :raise BridgeException: bridge server is not available or refuses the request
+    """
+
+    # The cache can be invalidated while waiting, ex. by SSH_AUTH_FAIL of another client
+    credentials = _credentials
+    if credentials is None:
+        credentials = await _fetch()
+    elif time.monotonic() - _fetched_at > settings.BRIDGE_CACHE_TTL:
+        _fetch()
+
+    return dict(credentials)
+
+
+def _fetch() -> asyncio.Task:
+    """ Start fetching credentials unless it is in progress """
+    global _fetching
+
+    if _fetching is None or _fetching.done():
+        _fetching = asyncio.ensure_future(_fetch_credentials())
+        # Mark the exception as retrieved. It is raised to the waiters if any.
+        _fetching.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return _fetching
+
+
+async def _fetch_credentials() -> dict:
+    headers = {'X-API-KEY': global_settings.BRIDGE_KEY}
+    start = time.perf_counter()
+    try:
+        resp = await http_client.get(settings.BRIDGE_URL + '/api/containers/info',
+                                     headers=headers)
+    except requests.RequestException:
+        raise BridgeException('Bridge is dead.')
+    finally:
+        metrics.bridge_request.observe(time.perf_counter() - start)
+
+    if not resp.ok:
+        # TODO: send sentry
+        try:
+            reason = resp.json()['error']
+        except:
+            reason = f'Bridge is dead. ({resp.status_code})'
+        raise BridgeException(reason)
+
+    try:
+        data = resp.json()
+        return set_credentials(data['cont_user'], data['cont_auth_type'], data['cont_auth'])
+    except (ValueError, KeyError):
+        raise BridgeException('Invalid response from bridge')
@@ -1,5 +1,9 @@
 import random
 import string
+import asyncio
+import functools
+from concurrent.futures import Executor
+from typing import Callable
 
 
 def rand_string(length: int = 64, ascii_=True, digits=True, punctuation=True) -> str:
@@ -14,3 +18,10 @@ def rand_string(length: int = 64, ascii_=True, digits=True, punctuation=True) ->
         chars += r"!%()*+,-.:;<=>?@[]^_{|}~"
 
     return ''.join(random.sample(chars, length))
+
+
+def run_blocking(executor: Executor, func: Callable, *args, **kwargs) -> asyncio.Future:
+    """ Run blocking ``func`` on ``executor`` and return an awaitable of its result """
+
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
@@ -15,3 +15,7 @@ class SSHStopRetryException(Exception):
 
 class SSHConnectionException(Exception):
     pass
+
+
+class BridgeException(Exception):
+    pass
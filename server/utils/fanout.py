@@ -0,0 +1,68 @@
+from typing import Any, Dict, List
+
+from socketio import packet
+
+from configs import settings
+from server import sio
+from server.utils import ws_session, metrics
+from server.utils.relay import SKIP_MARKER
+
+
+class Fanout:
+    """
+    Output of a terminal sent to read-only viewers, the clients in the socket.io room ``room``.
+
+    Frames of the owner's ``OutputRelay`` are passed on as they are, so each chunk is read
+    from the channel once, and each frame is encoded once for all the viewers.
+
+    Each viewer has its own backpressure. While ``SSH_OUTPUT_MAX_PENDING`` packets are queued
+    for a viewer, frames are not sent to it, and it is told how many bytes it missed once it
+    catches up. Nothing is buffered per viewer, so a slow viewer never holds the owner back.
+    """
+
+    def __init__(self, room: str, event: str):
+        self.room = room
+        self.event = event
+        self._skipped: Dict[str, int] = {}  # sid: bytes the viewer missed
+
+    def __len__(self):
+        return len(ws_session.room_members(self.room))
+
+    def join(self, sid: str):
+        sio.enter_room(sid, self.room)
+
+    def leave(self, sid: str):
+        sio.leave_room(sid, self.room)
+        self._skipped.pop(sid, None)
+
+    async def send(self, data: bytes):
+        """ Send a frame to the viewers keeping up """
+
+        viewers = ws_session.room_members(self.room)
+        if not viewers:
+            return
+
+        encoded = None
+        for sid, eio_sid in viewers:
+            if ws_session.eio_pending_packets(eio_sid) >= settings.SSH_OUTPUT_MAX_PENDING:
+                self._skipped[sid] = self._skipped.get(sid, 0) + len(data)
+                metrics.watch_bytes_skipped.inc(len(data))
+                continue
+
+            skipped = self._skipped.pop(sid, 0)
+            if skipped:
+                await self._send(eio_sid, self._encode(SKIP_MARKER.format(skipped).encode()))
+            if encoded is None:
+                encoded = self._encode(data)
+            await self._send(eio_sid, encoded)
+            metrics.watch_bytes_out.inc(len(data))
+
+    def _encode(self, data: Any) -> List[Any]:
+        """ socket.io packet(s) of the event. Binary data is sent as an attachment packet. """
+        encoded = sio.packet_class(packet.EVENT, namespace='/', data=[self.event, data]).encode()
+        return encoded if isinstance(encoded, list) else [encoded]
+
+    @staticmethod
+    async def _send(eio_sid: str, encoded: List[Any]):
+        for ep in encoded:
+            await sio.eio.send(eio_sid, ep)
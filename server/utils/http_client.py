@@ -0,0 +1,31 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from configs import settings
+from server.utils.etc import run_blocking
+
+# Keep connections to API, bridge and IDE servers alive, and send requests from
+# a bounded pool of threads so that the event loop is never blocked.
+session = requests.Session()
+session.mount('http://', HTTPAdapter(pool_maxsize=settings.HTTP_WORKERS))
+session.mount('https://', HTTPAdapter(pool_maxsize=settings.HTTP_WORKERS))
+executor = ThreadPoolExecutor(max_workers=settings.HTTP_WORKERS, thread_name_prefix='http')
+
+
+async def request(method: str, url: str, **kwargs) -> requests.Response:
+    """
+    Awaitable version of ``requests.request`` using the pooled session.
+    ``settings.HTTP_TIMEOUT`` is applied unless ``timeout`` is given.
+    """
+    kwargs.setdefault('timeout', settings.HTTP_TIMEOUT)
+    return await run_blocking(executor, session.request, method, url, **kwargs)
+
+
+async def get(url: str, **kwargs) -> requests.Response:
+    return await request('GET', url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> requests.Response:
+    return await request('POST', url, **kwargs)
@@ -0,0 +1,229 @@
+import os
+import asyncio
+import pwd
+import fcntl
+import errno
+import select
+import signal
+import socket
+import struct
+import termios
+import threading
+import subprocess
+from typing import Any, Dict, List, Optional
+
+
+class LocalPtyChannel:
+    """
+    Login shell running on a local pseudo terminal.
+    It provides the subset of ``paramiko.Channel`` that ``SSHWorker`` uses, so that
+    the worker can relay it without going through the loopback SSH connection.
+    """
+
+    def __init__(self, proc: subprocess.Popen, master_fd: int):
+        self.proc = proc
+        self.master_fd = master_fd
+        self.closed = False
+        self._writable: Optional[asyncio.Future] = None  # Resolved once the terminal has room for input
+
+    def __str__(self):
+        return f'<LocalPtyChannel pid={self.proc.pid} fd={self.master_fd}{" (closed)" if self.closed else ""}>'
+
+    @property
+    def active(self) -> bool:
+        return not self.closed
+
+    def fileno(self) -> int:
+        return self.master_fd
+
+    def settimeout(self, timeout: Optional[float]):
+        """ Master fd is always non-blocking. Kept for compatibility with ``paramiko.Channel`` """
+
+    def recv(self, nbytes: int) -> bytes:
+        """
+        Read available output. Like non-blocking ``paramiko.Channel``, raise
+        ``socket.timeout`` when there is nothing to read, and return empty bytes
+        when the shell has exited.
+        """
+        if self.closed:
+            return b''
+
+        try:
+            return os.read(self.master_fd, nbytes)
+        except BlockingIOError:
+            raise socket.timeout
+        except OSError as e:
+            if e.errno == errno.EIO:
+                # Every slave fd is closed. That is, the shell has exited.
+                return b''
+            raise
+
+    def sendall(self, data):
+        """ Write whole ``data`` into the terminal. This blocks while the terminal is full. Use :meth:`write` on the event loop. """
+        if isinstance(data, str):
+            data = data.encode()
+
+        view = memoryview(data)
+        while view:
+            try:
+                written = os.write(self.master_fd, view)
+            except BlockingIOError:
+                select.select([], [self.master_fd], [])
+                continue
+            view = view[written:]
+
+    async def write(self, data):
+        """
+        Write whole ``data`` into the terminal. While the terminal is full, ex. a program
+        does not read its input, this waits on the event loop without taking a thread.
+
+        :raise OSError: if the channel is closed meanwhile
+        """
+        if isinstance(data, str):
+            data = data.encode()
+
+        loop = asyncio.get_running_loop()
+        view = memoryview(data)
+        while view:
+            if self.closed:
+                raise OSError(errno.EBADF, 'Channel is closed')
+            try:
+                written = os.write(self.master_fd, view)
+            except BlockingIOError:
+                self._writable = loop.create_future()
+                loop.add_writer(self.master_fd, self._on_writable)
+                self._writable.add_done_callback(lambda _: loop.remove_writer(self.master_fd))
+                try:
+                    await self._writable
+                except asyncio.CancelledError:
+                    if self.closed:
+                        raise OSError(errno.EBADF, 'Channel is closed')
+                    raise
+                finally:
+                    self._writable = None
+                continue
+            view = view[written:]
+
+    def _on_writable(self):
+        if self._writable is not None and not self._writable.done():
+            self._writable.set_result(None)
+
+    def resize_pty(self, width: int = 80, height: int = 24,
+                   width_pixels: int = 0, height_pixels: int = 0):
+        fcntl.ioctl(self.master_fd, termios.TIOCSWINSZ,
+                    struct.pack('HHHH', height, width, width_pixels, height_pixels))
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self._writable is not None:
+            # Stop waiting to write, and unregister the fd before it is closed
+            self._writable.cancel()
+            asyncio.get_event_loop().remove_writer(self.master_fd)
+        os.close(self.master_fd)
+        try:
+            os.killpg(self.proc.pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass
+
+        # Reap the shell in the background. A shell trapping SIGHUP must not block the event loop.
+        if self.proc.poll() is None:
+            threading.Thread(target=_reap, args=(self.proc,), name='pty-reaper', daemon=True).start()
+
+
+class LocalPtyClient:
+    """
+    Stand-in of ``paramiko.SSHClient`` that spawns login shells of ``username``
+    on local pseudo terminals.
+    """
+
+    def __init__(self, username: str):
+        self.username = username
+        self.channels: List[LocalPtyChannel] = []
+
+    def __str__(self):
+        return f'<LocalPtyClient {self.username}>'
+
+    def invoke_shell(self, term: str = 'vt100', width: int = 80, height: int = 24,
+                     width_pixels: int = 0, height_pixels: int = 0) -> LocalPtyChannel:
+        pw = pwd.getpwnam(self.username)
+        shell = pw.pw_shell or '/bin/sh'
+        env = login_env(pw, TERM=term)
+
+        master_fd, slave_fd = os.openpty()
+        channel = None
+        try:
+            proc = subprocess.Popen(
+                ['-' + os.path.basename(shell)],  # Leading dash makes it a login shell
+                executable=shell,
+                stdin=slave_fd, stdout=slave_fd, stderr=slave_fd,
+                cwd=pw.pw_dir if os.path.isdir(pw.pw_dir) else '/',
+                env=env,
+                preexec_fn=_acquire_tty,
+                close_fds=True,
+                **login_as(pw),
+            )
+            os.set_blocking(master_fd, False)
+            channel = LocalPtyChannel(proc, master_fd)
+            channel.resize_pty(width, height, width_pixels, height_pixels)
+        finally:
+            os.close(slave_fd)
+            if channel is None:
+                os.close(master_fd)
+
+        self.channels = [c for c in self.channels if not c.closed]
+        self.channels.append(channel)
+        return channel
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
+        self.channels = []
+
+
+def _reap(proc: subprocess.Popen, grace: float = 1):
+    """ Wait for ``proc`` to exit after SIGHUP, and kill its process group if it does not in time """
+    try:
+        proc.wait(grace)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        proc.wait()
+
+
+def login_env(pw: pwd.struct_passwd, **extra) -> Dict[str, str]:
+    """ Environment variables of a fresh login of ``pw`` """
+
+    return dict({
+        'HOME': pw.pw_dir,
+        'SHELL': pw.pw_shell or '/bin/sh',
+        'USER': pw.pw_name,
+        'LOGNAME': pw.pw_name,
+        'PATH': '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+    }, **extra)
+
+
+def login_as(pw: pwd.struct_passwd) -> Dict[str, Any]:
+    """
+    Arguments of ``subprocess.Popen`` running the program as ``pw``, without ``preexec_fn``
+    that is unsafe in a process with threads. The child leads a new session, so that its
+    whole process group can be signaled.
+    """
+
+    kwargs: Dict[str, Any] = {'start_new_session': True}
+    if os.getuid() == 0:
+        kwargs.update(user=pw.pw_uid, group=pw.pw_gid,
+                      extra_groups=os.getgrouplist(pw.pw_name, pw.pw_gid))
+    return kwargs
+
+
+def _acquire_tty():
+    """
+    Make stdin the controlling terminal of the new session, so that job control works.
+    Run in the child by ``preexec_fn``, as ``subprocess`` has no argument for it.
+    """
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
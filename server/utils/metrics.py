@@ -0,0 +1,143 @@
+import time
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Sequence
+
+from configs import settings
+
+_families: Dict[str, dict] = OrderedDict()  # name: {'type': ..., 'help': ..., 'metrics': [...]}
+loop_monitor_task: Optional[asyncio.Task] = None
+
+
+def _register(metric, name: str, type_: str, help_: str):
+    family = _families.setdefault(name, {'type': type_, 'help': help_, 'metrics': []})
+    family['metrics'].append(metric)
+
+
+def _format_labels(labels: Dict[str, str], **extra) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+
+class Counter:
+    __slots__ = ('name', 'labels', 'value')
+
+    def __init__(self, name: str, help_: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        _register(self, name, 'counter', help_)
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels)} {self.value}']
+
+
+class Gauge:
+    """ Value read by ``func`` when metrics are rendered """
+
+    __slots__ = ('name', 'labels', 'func')
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, help_: str, func: Callable[[], float],
+                 labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.labels = labels or {}
+        self.func = func
+        _register(self, name, self.TYPE, help_)
+
+    def render(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels)} {self.func()}']
+
+
+class CounterFunc(Gauge):
+    """ Counter whose value is read by ``func``, that only goes up """
+
+    __slots__ = ()
+    TYPE = 'counter'
+
+
+class Histogram:
+    __slots__ = ('name', 'labels', 'buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, name: str, help_: str, buckets: Sequence[float],
+                 labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.labels = labels or {}
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        _register(self, name, 'histogram', help_)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{_format_labels(self.labels, le=bound)} {cumulative}')
+        lines.append(f'{self.name}_sum{_format_labels(self.labels)} {self.sum}')
+        lines.append(f'{self.name}_count{_format_labels(self.labels)} {self.count}')
+        return lines
+
+
+def render() -> str:
+    lines = []
+    for name, family in _families.items():
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["type"]}')
+        for metric in family['metrics']:
+            lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Updating a metric is an attribute increment, or a bisection for histograms,
+# so that it is cheap enough for the relay hot path.
+LATENCY_BUCKETS = (.0001, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+relay_bytes_out = Counter('agent_relay_bytes_total', 'Bytes relayed', {'direction': 'ssh_to_client'})
+relay_bytes_in = Counter('agent_relay_bytes_total', 'Bytes relayed', {'direction': 'client_to_ssh'})
+relay_messages_out = Counter('agent_relay_messages_total', 'Messages relayed', {'direction': 'ssh_to_client'})
+relay_messages_in = Counter('agent_relay_messages_total', 'Messages relayed', {'direction': 'client_to_ssh'})
+watch_bytes_out = Counter('agent_relay_bytes_total', 'Bytes relayed', {'direction': 'ssh_to_viewer'})
+relay_frame_size = Histogram('agent_relay_frame_bytes', 'Size of SSH_RELAY emits', SIZE_BUCKETS)
+relay_bytes_skipped = Counter('agent_relay_bytes_skipped_total',
+                              'Output bytes skipped because the terminal fell too far behind')
+watch_bytes_skipped = Counter('agent_watch_bytes_skipped_total',
+                              'Output bytes not sent to read-only viewers falling behind')
+keystroke_latency = Histogram('agent_keystroke_latency_seconds',
+                              'Time from receiving client input to writing it into the channel',
+                              LATENCY_BUCKETS)
+loop_lag = Histogram('agent_event_loop_lag_seconds', 'Delay of the event loop to wake a sleeping task',
+                     LATENCY_BUCKETS)
+auth_request = Histogram('agent_auth_request_seconds', 'Duration of token validation requests',
+                         LATENCY_BUCKETS)
+bridge_request = Histogram('agent_bridge_request_seconds', 'Duration of bridge requests', LATENCY_BUCKETS)
+
+
+async def monitor_loop_lag():
+    """ Measure how late the event loop wakes this task up """
+
+    interval = settings.METRICS_LOOP_LAG_INTERVAL
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+def start_loop_monitor():
+    global loop_monitor_task
+
+    if loop_monitor_task is None or loop_monitor_task.done():
+        loop_monitor_task = asyncio.create_task(monitor_loop_lag())
@@ -0,0 +1,341 @@
+"""
+Recording of terminal output, for grading and debugging.
+
+A recording is a directory of segments. Each segment is a log file and its sparse index.
+
+- ``00000.log``: ``SEGMENT_HEADER``(magic, start time in epoch seconds), then records of
+  ``RECORD``(milliseconds since the segment start, length) followed by the output bytes
+- ``00000.idx``: ``INDEX_ENTRY``(milliseconds, offset of a record in the log) written
+  every ``SSH_RECORD_INDEX_INTERVAL`` seconds of output
+
+A segment is rotated after ``SSH_RECORD_SEGMENT_SIZE`` bytes, and the oldest segments
+of all recordings are deleted when they take more than ``SSH_RECORD_MAX_SIZE`` bytes.
+"""
+import os
+import re
+import mmap
+import time
+import struct
+import asyncio
+import secrets
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+from configs import settings
+from server.utils.etc import run_blocking
+
+MAGIC = b'TCREC1\0\0'
+SEGMENT_HEADER = struct.Struct('<8sd')
+RECORD = struct.Struct('<IH')
+INDEX_ENTRY = struct.Struct('<II')
+MAX_RECORD_SIZE = 0xFFFF
+MAX_SEGMENT_MS = 0xFFFFFFFF
+
+FLUSH_SIZE = 64 * 1024  # Write without waiting for the interval once this many bytes are buffered
+NAME_PATTERN = re.compile(r'^(\d+)_(\d+)_[0-9a-f]+$')  # {user id}_{start time}_{random}
+
+# One thread, so that writes of a recording keep their order
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='recorder')
+open_segments: Set[str] = set()  # Paths without extension of the segments being written. Used on ``executor`` only.
+
+
+class SessionRecorder:
+    """
+    Append output of a terminal to a recording.
+
+    :meth:`write` only appends to a buffer in memory, so the relay never waits for the disk.
+    The buffer is written on ``executor`` every ``SSH_RECORD_FLUSH_INTERVAL`` seconds, or
+    once ``FLUSH_SIZE`` bytes are buffered.
+    """
+
+    def __init__(self, user_id: int, root: Optional[str] = None):
+        self.name = f'{user_id}_{int(time.time())}_{secrets.token_hex(4)}'
+        self.root = root or settings.SSH_RECORD_DIR
+        self.path = os.path.join(self.root, self.name)
+
+        self._segment = -1
+        self._start = 0.0  # Start time of the current segment
+        self._size = 0  # Bytes of the current segment, including the buffered ones
+        self._last_index: Optional[int] = None  # Milliseconds of the last index entry
+        self._pending: List[Tuple[int, bytearray, bytearray]] = []  # (segment, log, index) to write
+        self._buffered = 0
+
+        self._files: Optional[Tuple[int, BinaryIO, BinaryIO]] = None  # Used on ``executor`` only
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def __str__(self):
+        return f'<SessionRecorder {self.name}>'
+
+    def write(self, data: bytes):
+        """ Record ``data`` output at this moment """
+
+        now = time.time()
+        ms = max(int((now - self._start) * 1000), 0)  # The clock can go back
+        if self._segment < 0 or self._size >= settings.SSH_RECORD_SEGMENT_SIZE or ms > MAX_SEGMENT_MS:
+            self._rotate(now)
+            ms = 0
+
+        _, log, index = self._pending[-1]
+        if self._last_index is None or ms - self._last_index >= settings.SSH_RECORD_INDEX_INTERVAL * 1000:
+            index += INDEX_ENTRY.pack(ms, self._size)
+            self._last_index = ms
+
+        for i in range(0, len(data), MAX_RECORD_SIZE):
+            chunk = data[i:i + MAX_RECORD_SIZE]
+            log += RECORD.pack(ms, len(chunk))
+            log += chunk
+            self._size += RECORD.size + len(chunk)
+            self._buffered += RECORD.size + len(chunk)
+
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+        if self._buffered >= FLUSH_SIZE:
+            self._wakeup.set()
+
+    async def flush(self):
+        """ Write everything buffered """
+
+        if not self._buffered and len(self._pending) <= 1:
+            return
+
+        pending = self._pending
+        segment, _, _ = pending[-1]
+        self._pending = [(segment, bytearray(), bytearray())]
+        self._buffered = 0
+        await run_blocking(executor, self._write, pending)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        await self.flush()
+        await run_blocking(executor, self._close_files)
+
+    def _rotate(self, now: float):
+        self._segment += 1
+        self._start = now
+        self._size = SEGMENT_HEADER.size
+        self._last_index = None
+        self._pending.append((self._segment, bytearray(SEGMENT_HEADER.pack(MAGIC, now)), bytearray()))
+        self._buffered += SEGMENT_HEADER.size
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), settings.SSH_RECORD_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except OSError as e:
+                print(f'Failed to write {self}: {e!r}')
+
+    def _write(self, pending: List[Tuple[int, bytearray, bytearray]]):
+        """ Blocking part of ``flush`` """
+
+        for segment, log, index in pending:
+            if self._files is None or self._files[0] != segment:
+                self._close_files()
+                os.makedirs(self.path, exist_ok=True)
+                base = self._base(segment)
+                self._files = (segment, open(f'{base}.log', 'ab'), open(f'{base}.idx', 'ab'))
+                open_segments.add(base)
+                enforce_limit(self.root, settings.SSH_RECORD_MAX_SIZE, open_segments)
+
+            _, log_file, index_file = self._files
+            log_file.write(log)
+            index_file.write(index)
+            log_file.flush()
+            index_file.flush()
+
+    def _close_files(self):
+        if self._files is not None:
+            self._files[1].close()
+            self._files[2].close()
+            open_segments.discard(self._base(self._files[0]))
+            self._files = None
+
+    def _base(self, segment: int) -> str:
+        return os.path.join(self.path, f'{segment:05d}')
+
+
+def enforce_limit(root: str, limit: int, keep: Set[str]):
+    """ Delete the oldest segments but ``keep``(paths without extension) until ``root`` fits in ``limit`` bytes """
+
+    segments: Dict[str, List] = {}  # path without extension: [mtime, size]
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return
+
+    for name in names:
+        directory = os.path.join(root, name)
+        try:
+            files = os.listdir(directory)
+        except OSError:
+            continue
+        for file in files:
+            base, _ = os.path.splitext(os.path.join(directory, file))
+            try:
+                stat = os.stat(os.path.join(directory, file))
+            except OSError:
+                continue
+            segment = segments.setdefault(base, [0.0, 0])
+            segment[0] = max(segment[0], stat.st_mtime)
+            segment[1] += stat.st_size
+
+    total = sum(size for _, size in segments.values())
+    for base, (_, size) in sorted(segments.items(), key=lambda item: item[1][0]):
+        if total <= limit:
+            break
+        if base in keep:
+            continue
+
+        for ext in ('.log', '.idx'):
+            try:
+                os.unlink(base + ext)
+            except OSError:
+                pass
+        total -= size
+        try:
+            os.rmdir(os.path.dirname(base))  # Only when the recording is empty
+        except OSError:
+            pass
+
+
+def list_recordings(user_id: Optional[int] = None, root: Optional[str] = None) -> List[Dict]:
+    """ Recordings of ``user_id``, or all, in the order they started """
+
+    root = root or settings.SSH_RECORD_DIR
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return []
+
+    recordings = []
+    for name in names:
+        match = NAME_PATTERN.match(name)
+        if not match or (user_id is not None and int(match.group(1)) != user_id):
+            continue
+
+        segments = _segments(os.path.join(root, name))
+        if not segments:
+            continue
+        recordings.append({
+            'name': name,
+            'user_id': int(match.group(1)),
+            'start': segments[0][0],
+            'end': max(os.stat(f'{base}.log').st_mtime for _, base in segments),
+            'size': sum(os.stat(f'{base}.log').st_size for _, base in segments),
+        })
+    return sorted(recordings, key=lambda r: r['start'])
+
+
+def read_recording(name: str, since: float = 0, until: Optional[float] = None,
+                   max_bytes: int = 1024 * 1024, cursor: Optional[str] = None,
+                   root: Optional[str] = None) -> Tuple[List[Tuple[float, bytes]], Optional[str]]:
+    """
+    Output recorded from ``since`` to ``until``(epoch seconds) as (time, data) pairs, and the cursor
+    to continue from when ``max_bytes`` is reached. The log is read from the nearest index entry,
+    not from the start.
+
+    :param cursor: ``{segment}:{offset}`` returned before. Reading continues right after the
+                   records returned then, and ``since`` is ignored.
+    :raise FileNotFoundError: if there is no such recording
+    :raise ValueError: if ``cursor`` is malformed
+    """
+
+    if not NAME_PATTERN.match(name):
+        raise FileNotFoundError(name)
+    segments = _segments(os.path.join(root or settings.SSH_RECORD_DIR, name))
+    if not segments:
+        raise FileNotFoundError(name)
+
+    if cursor is None:
+        # The last segment started at or before ``since``
+        first = max(bisect_right([start for start, _ in segments], since) - 1, 0)
+    else:
+        cursor_segment, cursor_offset = (int(value) for value in cursor.split(':'))
+        # The segment of the cursor, or the next one if it is deleted
+        first = bisect_left([_number(base) for _, base in segments], cursor_segment)
+
+    chunks = []
+    size = 0
+    for start, base in segments[first:]:
+        if until is not None and start > until:
+            break
+        number = _number(base)
+
+        with open(f'{base}.log', 'rb') as fp:
+            try:
+                log = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty file
+                continue
+
+        with log:
+            if cursor is None:
+                offset = _seek(base, int((since - start) * 1000))
+            elif number == cursor_segment:
+                offset = max(cursor_offset, SEGMENT_HEADER.size)
+            else:
+                offset = SEGMENT_HEADER.size
+            while offset + RECORD.size <= len(log):
+                ms, length = RECORD.unpack_from(log, offset)
+                if offset + RECORD.size + length > len(log):
+                    break  # Being written
+                at = start + ms / 1000
+                if until is not None and at > until:
+                    return chunks, None
+                if cursor is not None or at >= since:
+                    if size + length > max_bytes and chunks:
+                        return chunks, f'{number}:{offset}'
+                    chunks.append((at, log[offset + RECORD.size:offset + RECORD.size + length]))
+                    size += length
+                offset += RECORD.size + length
+
+    return chunks, None
+
+
+def _segments(path: str) -> List[Tuple[float, str]]:
+    """ (start time, path without extension) of the segments of a recording """
+
+    try:
+        files = sorted(file for file in os.listdir(path) if file.endswith('.log'))
+    except OSError:
+        return []
+
+    segments = []
+    for file in files:
+        base = os.path.join(path, file[:-len('.log')])
+        try:
+            with open(f'{base}.log', 'rb') as fp:
+                magic, start = SEGMENT_HEADER.unpack(fp.read(SEGMENT_HEADER.size))
+        except (OSError, struct.error):
+            continue
+        if magic == MAGIC:
+            segments.append((start, base))
+    return segments
+
+
+def _number(base: str) -> int:
+    """ Number of the segment at ``base`` """
+    return int(os.path.basename(base))
+
+
+def _seek(base: str, ms: int) -> int:
+    """ Offset of the last indexed record at or before ``ms`` in the segment """
+
+    try:
+        with open(f'{base}.idx', 'rb') as fp:
+            index = fp.read()
+    except OSError:
+        return SEGMENT_HEADER.size
+
+    entries = len(index) // INDEX_ENTRY.size
+    times = [INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)[0] for i in range(entries)]
+    i = bisect_right(times, ms) - 1
+    if i < 0:
+        return SEGMENT_HEADER.size
+    return INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)[1]
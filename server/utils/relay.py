@@ -0,0 +1,232 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from configs import settings
+from server.utils import metrics
+
+SKIP_MARKER = '\r\n[... {} bytes of output skipped ...]\r\n'
+
+
+class TokenBucket:
+    """ Allow ``rate`` bytes per second on average, and bursts of up to ``burst`` bytes """
+
+    def __init__(self, rate: int, burst: int):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self, size: int) -> int:
+        """
+        Wait until ``size`` bytes can be sent and consume them.
+        Return the number of bytes allowed, which is at most ``burst``.
+        """
+        if not self.rate:
+            return size
+
+        size = min(size, self.burst)
+        self._refill()
+        if self._tokens < size:
+            await asyncio.sleep((size - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= size
+        return size
+
+
+class OutputRelay:
+    """
+    Outbound stage between a terminal and the client(browser).
+
+    Output is merged into frames of at most ``SSH_OUTPUT_FRAME_SIZE`` bytes.
+    The first chunk after an idle period is sent right away to keep echoes
+    snappy, and the following chunks are merged within ``SSH_OUTPUT_FLUSH_INTERVAL``.
+
+    When the client cannot keep up, frames are held until its pending queue
+    shrinks, and :meth:`put` blocks the reader once ``SSH_OUTPUT_HIGH_WATER``
+    bytes are buffered, so that memory stays bounded.
+
+    Each terminal relays at most ``SSH_OUTPUT_RATE`` bytes per second, so that a
+    flooding program(ex. `yes`) cannot take the event loop from the other terminals.
+    Throttled output is not dropped. It fills the buffer, and the reader is blocked.
+
+    Only when the client itself is behind(``SSH_OUTPUT_MAX_PENDING``) and more than
+    ``SSH_OUTPUT_COLLAPSE_SIZE`` bytes are buffered, the middle of them is replaced
+    with a marker and only the latest output is kept.
+    """
+
+    def __init__(self,
+                 emit: Callable[[bytes], Awaitable[None]],
+                 pending: Callable[[], int],
+                 rate: Optional[int] = None,
+                 collapse_size: Optional[int] = None):
+        """
+        :param emit: coroutine function sending a frame to the client
+        :param pending: function returning the number of packets the client has not received yet
+        :param rate: ``SSH_OUTPUT_RATE`` of this relay. 0 for unlimited.
+        :param collapse_size: ``SSH_OUTPUT_COLLAPSE_SIZE`` of this relay. 0 to disable.
+        """
+        self._emit = emit
+        self._pending = pending
+        self._collapse_size = settings.SSH_OUTPUT_COLLAPSE_SIZE if collapse_size is None else collapse_size
+
+        self._buf = bytearray()
+        self._readable = asyncio.Event()  # Set when ``_buf`` is not empty
+        self._writable = asyncio.Event()  # Set when ``_buf`` is below high-water mark
+        self._writable.set()
+        self._last_flush = 0.0
+        self._bucket = TokenBucket(settings.SSH_OUTPUT_RATE if rate is None else rate, settings.SSH_OUTPUT_BURST)
+        self._skipped = 0  # Bytes skipped since the marker at the head of ``_buf`` was made
+        self._marker_len = 0  # Length of the marker at the head of ``_buf``
+
+    def __len__(self):
+        return len(self._buf)
+
+    @property
+    def is_full(self) -> bool:
+        return len(self._buf) >= settings.SSH_OUTPUT_HIGH_WATER
+
+    async def put(self, data: bytes):
+        """ Buffer ``data``. Wait for the buffer to be drained if it is full. """
+
+        self._buf += data
+        self._readable.set()
+
+        if self._collapse_size and len(self._buf) > self._collapse_size \
+                and self._pending() >= settings.SSH_OUTPUT_MAX_PENDING:
+            self._collapse(self._collapse_size // 2)
+
+        if self.is_full:
+            self._writable.clear()
+            await self._writable.wait()
+
+    async def run(self):
+        """ Send buffered output to the client until cancelled """
+
+        loop = asyncio.get_running_loop()
+        interval = settings.SSH_OUTPUT_FLUSH_INTERVAL
+
+        while True:
+            await self._readable.wait()
+
+            # Wait for more output unless the frame is already full
+            delay = self._last_flush + interval - loop.time()
+            if delay > 0 and len(self._buf) < settings.SSH_OUTPUT_FRAME_SIZE:
+                await asyncio.sleep(delay)
+
+            # Backpressure. Hold frames until the client consumes its queue.
+            while self._pending() >= settings.SSH_OUTPUT_MAX_PENDING:
+                await asyncio.sleep(interval)
+
+            size = await self._bucket.take(min(len(self._buf), settings.SSH_OUTPUT_FRAME_SIZE))
+            if not self._buf:  # Cleared while waiting
+                continue
+
+            self._last_flush = loop.time()
+            await self._emit(self._pop(size))
+
+    def clear(self):
+        """ Discard everything buffered """
+
+        self._buf.clear()
+        self._skipped = 0
+        self._marker_len = 0
+        self._readable.clear()
+        self._writable.set()
+
+    async def flush(self):
+        """ Send everything buffered immediately """
+
+        while self._buf:
+            await self._emit(self._pop(settings.SSH_OUTPUT_FRAME_SIZE))
+
+    def _collapse(self, keep: int):
+        """ Keep the last ``keep`` bytes from a line start, and mark the skipped ones """
+
+        start = len(self._buf) - keep
+        newline = self._buf.find(b'\n', start)
+        if newline != -1:
+            start = newline + 1
+
+        # A marker still buffered is replaced with the one counting it up
+        skipped = start - self._marker_len
+        self._skipped += skipped
+        metrics.relay_bytes_skipped.inc(skipped)
+
+        marker = SKIP_MARKER.format(self._skipped).encode()
+        self._buf[:start] = marker
+        self._marker_len = len(marker)
+
+    def _pop(self, size: int) -> bytes:
+        frame = bytes(self._buf[:size])
+        del self._buf[:size]
+
+        self._marker_len = max(self._marker_len - size, 0)
+        if not self._marker_len:
+            self._skipped = 0
+
+        if not self._buf:
+            self._readable.clear()
+        if not self.is_full:
+            self._writable.set()
+        return frame
+
+
+class RingBuffer:
+    """
+    Fixed-size byte buffer keeping the last ``size`` bytes written into it.
+    The memory is allocated once, so the cost per terminal is predictable.
+    """
+
+    def __init__(self, size: int):
+        self._size = size
+        self._view = memoryview(bytearray(size))
+        self._pos = 0  # Where the next byte is written
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    @property
+    def is_full(self) -> bool:
+        """ Whether the oldest bytes have been overwritten (or are about to be) """
+        return self._len == self._size
+
+    def write(self, data: bytes):
+        size = self._size
+        n = len(data)
+        if not size or not n:
+            return
+
+        data = memoryview(data)
+        if n >= size:
+            self._view[:] = data[n - size:]
+            self._pos = 0
+            self._len = size
+            return
+
+        end = self._pos + n
+        if end <= size:
+            self._view[self._pos:end] = data
+        else:
+            first = size - self._pos
+            self._view[self._pos:] = data[:first]
+            self._view[:n - first] = data[first:]
+
+        self._pos = end % size
+        self._len = min(self._len + n, size)
+
+    def getvalue(self) -> bytes:
+        """ Return buffered bytes from the oldest to the newest """
+        if not self.is_full:
+            return self._view[:self._len].tobytes()
+        return self._view[self._pos:].tobytes() + self._view[:self._pos].tobytes()
+
+    def clear(self):
+        self._pos = 0
+        self._len = 0
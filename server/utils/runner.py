@@ -0,0 +1,139 @@
+import os
+import pwd
+import signal
+import asyncio
+import functools
+from typing import Dict, Optional
+
+from configs import settings
+from server import sio
+from server.utils import ws_session
+from server.utils.relay import OutputRelay
+from server.utils.local_pty import login_env, login_as
+from server.websocket import OutEvent
+
+CHUNK_SIZE = 32 * 1024
+
+runners: Dict[str, 'ProgramRunner'] = {}  # sid: program running for the client
+
+
+class ExitReason:
+    EXIT = 'exit'
+    TIMEOUT = 'timeout'
+    CANCELLED = 'cancelled'
+
+
+class ProgramRunner:
+    """
+    Program executed as ``settings.USERNAME`` in ``settings.SSH_DEFAULT_DIR``, without a terminal.
+    stdout and stderr are batched by ``OutputRelay`` and sent as RUN_STDOUT and RUN_STDERR.
+    """
+
+    def __init__(self, sid: str, cmd: str, timeout: float):
+        self.sid = sid
+        self.cmd = cmd
+        self.timeout = timeout
+        self.reason = ExitReason.EXIT
+        self.proc: Optional[asyncio.subprocess.Process] = None
+
+        # Output of a program is never throttled or skipped. A program printing faster than
+        # the client receives waits on its pipe instead.
+        pending = functools.partial(ws_session.pending_packets, sid)
+        self.stdout = OutputRelay(functools.partial(self._emit, OutEvent.RUN_STDOUT), pending,
+                                  rate=0, collapse_size=0)
+        self.stderr = OutputRelay(functools.partial(self._emit, OutEvent.RUN_STDERR), pending,
+                                  rate=0, collapse_size=0)
+
+    def __str__(self):
+        return f'<ProgramRunner {self.sid} `{self.cmd}`>'
+
+    async def run(self) -> Optional[int]:
+        """ Execute the program and wait for it to exit. Return the exit code. """
+
+        pw = pwd.getpwnam(settings.USERNAME)
+        self.proc = await asyncio.create_subprocess_shell(
+            self.cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            cwd=settings.SSH_DEFAULT_DIR,
+            env=login_env(pw),
+            **login_as(pw),
+        )
+
+        relays = [asyncio.create_task(self.stdout.run()), asyncio.create_task(self.stderr.run())]
+        try:
+            await asyncio.wait_for(self._communicate(), self.timeout or None)
+        except asyncio.TimeoutError:
+            self.reason = ExitReason.TIMEOUT
+            await self.kill()
+        finally:
+            for task in relays:
+                task.cancel()
+
+        await self.stdout.flush()
+        await self.stderr.flush()
+        await sio.emit(OutEvent.RUN_EXIT,
+                       {'code': self.proc.returncode, 'reason': self.reason},
+                       room=self.sid)
+        return self.proc.returncode
+
+    async def write(self, data: Optional[str]):
+        """ Write ``data`` into stdin of the program. ``None`` closes stdin. """
+
+        if self.proc is None or self.proc.stdin.is_closing():
+            return
+
+        try:
+            if data is None:
+                self.proc.stdin.close()
+            else:
+                self.proc.stdin.write(data.encode())
+                await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The program exited or closed its stdin
+
+    async def cancel(self):
+        self.reason = ExitReason.CANCELLED
+        await self.kill()
+
+    async def kill(self):
+        """ Terminate the process group of the program, and kill it if it does not exit in time """
+
+        if self.proc is None or self.proc.returncode is not None:
+            return
+
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(self.proc.pid, sig)
+            except ProcessLookupError:
+                return
+            try:
+                await asyncio.wait_for(self.proc.wait(), settings.RUN_KILL_GRACE)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    async def _communicate(self):
+        await asyncio.gather(self._pump(self.proc.stdout, self.stdout),
+                             self._pump(self.proc.stderr, self.stderr))
+        await self.proc.wait()
+
+    @staticmethod
+    async def _pump(stream: asyncio.StreamReader, relay: OutputRelay):
+        while True:
+            data = await stream.read(CHUNK_SIZE)
+            if not data:
+                return
+            await relay.put(data)
+
+    async def _emit(self, event: str, data: bytes):
+        await sio.emit(event, data, room=self.sid)
+
+
+async def cancel_run(sid: str):
+    """ Kill the program running for ``sid`` if any """
+
+    runner = runners.get(sid)
+    if runner:
+        await runner.cancel()
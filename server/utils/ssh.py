@@ -1,11 +1,17 @@
 from __future__ import annotations
 
+import time
 import socket
+import secrets
 import json
+import hashlib
 import asyncio
+import ipaddress
 from enum import Enum
-from typing import Dict, Set, Any, Optional
+from typing import Dict, List, Set, Any, Optional, Union
 from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import paramiko
 from paramiko import (
@@ -13,18 +19,30 @@ from paramiko import (
     AutoAddPolicy,
 )
 from paramiko.channel import Channel
-from configs import Settings
+from configs import settings
 
 from server import sio
-from server.utils import ws_session
+from server.utils import ws_session, metrics
+from server.utils.etc import run_blocking
+from server.utils.relay import OutputRelay, RingBuffer
+from server.utils.fanout import Fanout
+from server.utils.recorder import SessionRecorder
+from server.utils.local_pty import LocalPtyClient, LocalPtyChannel
 from server.utils.exceptions import SSHStopRetryException, SSHConnectionException
 from server.models import User, ConnectionInfo
 from server.websocket import InEvent, OutEvent
 
 MAX_SSH_CONNECTION = 5  # Maximum number of SSH connection per user
 
-# TODO for scalability, save to and load from DB
-ssh_clients: Dict[str, Set[SSHWorker]] = defaultdict(set)  # (user-id, ip): {ssh-worker1, ...}
+reaper_stats = {'reaped': 0, 'evicted': 0}  # Number of workers destructed by the reaper
+reaper_task: Optional[asyncio.Task] = None
+
+# Paramiko calls are blocking. Run them in separate pools so that slow handshakes
+# never delay the input of users already connected.
+connect_executor = ThreadPoolExecutor(max_workers=settings.SSH_CONNECT_WORKERS,
+                                      thread_name_prefix='ssh-connect')
+io_executor = ThreadPoolExecutor(max_workers=settings.SSH_IO_WORKERS,
+                                 thread_name_prefix='ssh-io')
 
 
 class WorkerStatus(Enum):
@@ -40,6 +58,9 @@ class Reason:
     SSH_FAIL = 'Cannot connect to the SSH server.'
     SSH_DOWN = 'SSH server down'
     SSH_CHAN_CLOSE = 'SSH channel closed'
+    SSH_TOO_MANY_TOTAL = 'Too many terminals are open in this container'
+    SSH_NOT_FOUND = 'The terminal is not found'
+    SSH_RESUMED = 'The terminal is opened in another window'
 
     SERVER_DOWN = 'Server down'  # Normally on KeyboardInterrupt
     WS_DISCONNECTED = 'Websocket disconnected'
@@ -51,23 +72,45 @@ class SSHWorker:
     Thus, it would be more comfortable to users to keep ``SSHWorker`` alive and recycle
     it for the next connection.
 
-    TODO: delete idle instance after n seconds of disconnection, and remove from ssh_clients map.
+    Output is read from ``client``, that is either an SSH connection or a local pseudo
+    terminal(``settings.TERMINAL_BACKEND``). Both provide the same channel interface.
+
+    Disconnected workers are destructed by ``run_reaper`` after ``settings.SSH_WORKER_TTL``
+    seconds, or earlier when there are more than ``settings.SSH_MAX_WORKERS`` workers.
+
+    Clients presenting ``watch_token`` by SSH_WATCH receive the output as read-only
+    ``viewers``, while the owner is connected.
+
+    With ``settings.SSH_RECORD``, the output is also recorded by ``recorder`` from the
+    first connection on.
     """
 
     BUF_SIZE = 32 * 1024
+    POLL_INTERVAL = 0.01  # Used when ``settings.SSH_RELAY_EVENT_DRIVEN`` is off
 
-    def __init__(self, sid: str, connection_info: ConnectionInfo, client: SSHClient):
-        self.sid: str = sid
-        self.connection_info: ConnectionInfo = connection_info
+    def __init__(self, sid: Optional[str], connection_info: Optional[ConnectionInfo],
+                 client: Union[SSHClient, LocalPtyClient]):
+        # Both are None while the worker is a spare of ``warm_pool``
+        self.sid: Optional[str] = sid
+        self.connection_info: Optional[ConnectionInfo] = connection_info
 
-        self.client: SSHClient = client
-        self.channel: Optional[Channel] = None
+        self.client: Union[SSHClient, LocalPtyClient] = client
+        self.channel: Optional[Union[Channel, LocalPtyChannel]] = None
         self.ssh_retry = 5
-        self.set_ssh_channel()
+        self._send_lock = asyncio.Lock()  # Keep the order of user input
+        self._channel_lock = asyncio.Lock()  # Invoke only one shell at a time
 
         self.status: WorkerStatus = WorkerStatus.DISCONNECTED
+        self.disconnected_at: Optional[float] = time.monotonic()  # None while connected
+        self.relay = OutputRelay(self._emit_relay, lambda: ws_session.pending_packets(self.sid))
+        self.scrollback = RingBuffer(settings.SSH_SCROLLBACK_SIZE)
+        self.watch_token = secrets.token_urlsafe(24)
+        self.viewers = Fanout(f'watch:{self.watch_token}', OutEvent.SSH_WATCH_RELAY)
+        self.recorder: Optional[SessionRecorder] = None
+        self.output_started = asyncio.Event()  # Set once the shell outputs anything, ex. the prompt
         self.awaitable_recv_client: Optional[asyncio.tasks.Task] = None
         self.awaitable_recv_ssh: Optional[asyncio.tasks.Task] = None
+        self.awaitable_relay: Optional[asyncio.tasks.Task] = None
 
     def __repr__(self):
         return self.__str__()
@@ -87,11 +130,16 @@ class SSHWorker:
         """ self-destruction """
 
         self.status = WorkerStatus.DISCONNECTED
-        self.channel.close()
-        self.client.close()
+        self.ssh_retry = -1  # Never invoke a shell again
+        if self.channel:
+            self.channel.close()
+        transport_pool.release(self.client)
         self.stop_tasks('destruct')
+        if self.recorder:
+            asyncio.ensure_future(self.recorder.close())
+            self.recorder = None
 
-    def set_ssh_channel(self):
+    async def set_ssh_channel(self):
         """
         Create ``paramiko.channel`` instance that might be closed in the middle
         of receiving messages
@@ -100,17 +148,24 @@ class SSHWorker:
         if not (self.channel is None or self.channel.closed):
             return
 
-        try:
-            self.channel = self.client.invoke_shell()
-        except paramiko.SSHException:
-            self.cleanup(Reason.SSH_DOWN, True)
-            self.ssh_retry -= 1
-
+        async with self._channel_lock:
+            if not (self.channel is None or self.channel.closed):
+                # Invoked by another task while waiting for the lock
+                return
             if self.ssh_retry < 0:
                 raise SSHStopRetryException
-            raise IOError
 
-    def setup_recycle(self, sid: str, connection_info: ConnectionInfo):
+            try:
+                self.channel = await run_blocking(connect_executor, self.client.invoke_shell)
+                self.channel.settimeout(0)
+            except (paramiko.SSHException, OSError):
+                self.ssh_retry -= 1
+
+                if self.ssh_retry < 0:
+                    raise SSHStopRetryException
+                raise IOError
+
+    async def setup_recycle(self, sid: str, connection_info: ConnectionInfo):
         """
         setup variables for the next websocket user
         """
@@ -118,6 +173,15 @@ class SSHWorker:
         self.connection_info = connection_info
         # self.channel.sendall(b'\f')  # ctrl + l
 
+        if settings.SSH_SCROLLBACK_SIZE:
+            # Restore the screen of the new client with recent output at once.
+            # Output not sent yet is included in the scrollback.
+            self.relay.clear()
+            data = self.replay_data()
+            if data:
+                await self._emit_owner_relay(data)
+            return
+
         # (Workaround) Resize pty in order to show current pty screen.
         # Imagine that user executes `watch -n 1 "date". The next time the user reconnects the pty
         # without resizing, s/he will be shown only changed text not the whole one.
@@ -127,6 +191,16 @@ class SSHWorker:
                         width_pixels=0,
                         height_pixels=0)
 
+    def replay_data(self) -> bytes:
+        """ Return the scrollback starting from a line boundary """
+        data = self.scrollback.getvalue()
+        if self.scrollback.is_full:
+            # The oldest line is likely to be cut in the middle
+            newline = data.find(b'\n')
+            if newline >= 0:
+                data = data[newline + 1:]
+        return data
+
     def resize_pty(self, width: int, height: int,
                    width_pixels: int = 0, height_pixels: int = 0):
         # TODO 유저의 터미널 크기 변경에 대해 적용. 터미널 선택 시에도 호출
@@ -138,28 +212,38 @@ class SSHWorker:
     async def run(self):
         """ Run asynchronous tasks """
         self.awaitable_recv_ssh = asyncio.create_task(self.recv_from_ssh())
+        self.awaitable_relay = asyncio.create_task(self.relay.run())
 
         try:
-            await asyncio.gather(
-                self.awaitable_recv_ssh,
-            )
+            await self.awaitable_recv_ssh
         except asyncio.CancelledError:
             return
+        finally:
+            self.awaitable_relay.cancel()
 
     def stop_tasks(self, reason):
         """ Stop asynchronous tasks """
-        if not self.awaitable_recv_ssh.done():
-            self.awaitable_recv_ssh.cancel(reason)
+        for task in (self.awaitable_recv_ssh, self.awaitable_relay):
+            if task and not task.done():
+                task.cancel(reason)
 
     def sio_accepted(self, sid):
         self.sid = sid
         self.status = WorkerStatus.CONNECTED
+        self.disconnected_at = None
+        if settings.SSH_RECORD and self.recorder is None:
+            self.recorder = SessionRecorder(self.connection_info.user.user_id)
 
     async def cleanup(self, reason: str, send_close: bool):
-        if send_close and ws_session.is_connected(self.sid):
-            await self._emit(OutEvent.SSH_DOWN, {'type': 'ssh closed', 'message': reason})
+        if send_close:
+            data = {'type': 'ssh closed', 'message': reason}
+            if ws_session.is_connected(self.sid):
+                await self._emit(OutEvent.SSH_DOWN, data)
+            await sio.emit(OutEvent.SSH_DOWN, data, room=self.viewers.room)
 
         self.status = WorkerStatus.DISCONNECTED
+        if self.disconnected_at is None:
+            self.disconnected_at = time.monotonic()
 
     async def recv_from_client(self, data):
         """
@@ -167,12 +251,22 @@ class SSHWorker:
         the SSH server
         """
 
+        start = time.perf_counter()
         try:
             # Ensure SSH connection
-            self.set_ssh_channel()
+            await self.set_ssh_channel()
 
             # Send to SSH server
-            self.channel.sendall(data)
+            async with self._send_lock:
+                if isinstance(self.channel, LocalPtyChannel):
+                    # Waits for a full terminal on the loop, not to take every thread of ``io_executor``
+                    await self.channel.write(data)
+                else:
+                    await run_blocking(io_executor, self.channel.sendall, data)
+
+            metrics.keystroke_latency.observe(time.perf_counter() - start)
+            metrics.relay_messages_in.inc()
+            metrics.relay_bytes_in.inc(len(data))
         except SSHStopRetryException:
             # Stop trying to reconnect SSH
             await self.cleanup(Reason.SSH_DOWN, True)
@@ -186,49 +280,516 @@ class SSHWorker:
         client(browser)
         """
 
-        reason = ''
-        send_close = True
+        if settings.SSH_RELAY_EVENT_DRIVEN:
+            reason = await self._relay_on_readiness()
+        else:
+            reason = await self._relay_on_polling()
+
+        await self.relay.flush()
+        await self.cleanup(reason, True)
+
+    async def _relay_on_polling(self) -> str:
+        """ Poll the channel every ``POLL_INTERVAL`` seconds """
+
         while self.is_connected:
-            await asyncio.sleep(0.01)
+            await asyncio.sleep(self.POLL_INTERVAL)
             try:
-                self.set_ssh_channel()
+                await self.set_ssh_channel()
 
                 data = self.channel.recv(self.BUF_SIZE)
                 if len(data) <= 0:
                     continue
 
-                await self._emit(OutEvent.SSH_RELAY, data)
+                await self._on_output(data)
             except KeyboardInterrupt:
-                reason = Reason.SERVER_DOWN
-                break
+                return Reason.SERVER_DOWN
             except (OSError, IOError):
                 # including socket.timeout
                 continue
             except SSHStopRetryException:
-                reason = Reason.SSH_DOWN
-                break
-            except:
-                reason = 'Unknown error'
-                break
+                return Reason.SSH_DOWN
+            except Exception:
+                return 'Unknown error'
+
+        return ''
+
+    async def _relay_on_readiness(self) -> str:
+        """
+        Read the channel only when it has something to read.
+        ``Channel.fileno()`` is a pipe that paramiko makes readable whenever its
+        input buffer is filled or the channel is closed, so an idle terminal does
+        not wake the event loop at all. It yields after every read, so that flooding
+        terminals take turns with the others.
+        """
+
+        loop = asyncio.get_running_loop()
+        while self.is_connected:
+            try:
+                await self.set_ssh_channel()
+
+                data = self.channel.recv(self.BUF_SIZE)
+                if len(data) <= 0:
+                    # EOF. Close the channel so that a new shell is invoked.
+                    self.channel.close()
+                    continue
+
+                await self._on_output(data)
+                await asyncio.sleep(0)
+            except socket.timeout:
+                # Input buffer is drained
+                await wait_readable(loop, self.channel.fileno())
+            except KeyboardInterrupt:
+                return Reason.SERVER_DOWN
+            except (OSError, IOError):
+                await asyncio.sleep(self.POLL_INTERVAL)
+            except SSHStopRetryException:
+                return Reason.SSH_DOWN
+            except Exception:
+                return 'Unknown error'
 
-        await self.cleanup(reason, send_close)
+        return ''
+
+    async def _on_output(self, data: bytes):
+        """ Handle output read from the terminal """
+        self.output_started.set()
+        self.scrollback.write(data)
+        if self.recorder:
+            self.recorder.write(data)
+        await self.relay.put(data)
 
     async def _emit(self, event: str, data: Any):
         await sio.emit(event, data, room=self.sid)
 
+    async def _emit_relay(self, data: bytes):
+        """ Send a frame of ``relay`` to the owner and the viewers """
+        await self._emit_owner_relay(data)
+        await self.viewers.send(data)
+
+    async def _emit_owner_relay(self, data: bytes):
+        metrics.relay_messages_out.inc()
+        metrics.relay_bytes_out.inc(len(data))
+        metrics.relay_frame_size.observe(len(data))
+        await self._emit(OutEvent.SSH_RELAY, data)
+
+
+class WorkerRecord:
+    """ Entry of ``WorkerRegistry``. Keys are computed once, when the worker is registered. """
+
+    __slots__ = ('worker', 'user_id', 'connection_key', 'token')
+
+    def __init__(self, worker: SSHWorker, user_id: int, connection_key: str, token: str):
+        self.worker = worker
+        self.user_id = user_id
+        self.connection_key = connection_key
+        self.token = token
+
+
+class WorkerRegistry:
+    """
+    Live workers indexed by user, by connection(``ConnectionInfo.key``) and by resume token.
+
+    A resume token is handed to the client with SSH_RESUME. Presenting it in SSH_CONNECT
+    reattaches the disconnected worker of the same user, even from another IP.
+    Tokens are replaced whenever a worker is attached, so each one is used once.
+    Watch tokens(``SSHWorker.watch_token``) stay the same for the lifetime of the worker.
+    """
+
+    def __init__(self):
+        # TODO for scalability, save to and load from DB
+        self._records: Dict[SSHWorker, WorkerRecord] = {}
+        self._by_user: Dict[int, Set[SSHWorker]] = defaultdict(set)
+        self._by_connection: Dict[str, Set[SSHWorker]] = defaultdict(set)
+        self._by_token: Dict[str, SSHWorker] = {}
+        self._by_watch_token: Dict[str, SSHWorker] = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def __iter__(self):
+        return iter(list(self._records))
+
+    def user_count(self, user_id: int) -> int:
+        return len(self._by_user.get(user_id, ()))
+
+    def of_user(self, user_id: int) -> List[SSHWorker]:
+        return list(self._by_user.get(user_id, ()))
+
+    def of_connection(self, connection_key: str) -> List[SSHWorker]:
+        return list(self._by_connection.get(connection_key, ()))
+
+    def token(self, worker: SSHWorker) -> str:
+        return self._records[worker].token
+
+    def by_token(self, token: str, user_id: int) -> Optional[SSHWorker]:
+        """ Worker of the resume token, if it belongs to ``user_id`` """
+
+        worker = self._by_token.get(token)
+        if worker is None or self._records[worker].user_id != user_id:
+            return None
+        return worker
+
+    def by_watch_token(self, token: str) -> Optional[SSHWorker]:
+        return self._by_watch_token.get(token)
+
+    def add(self, worker: SSHWorker, connection_info: ConnectionInfo):
+        """ Register ``worker``, or move it to ``connection_info`` with a new token if registered """
+
+        self.remove(worker)
+        record = WorkerRecord(worker, connection_info.user.user_id, connection_info.key,
+                              secrets.token_urlsafe(24))
+        self._records[worker] = record
+        self._by_user[record.user_id].add(worker)
+        self._by_connection[record.connection_key].add(worker)
+        self._by_token[record.token] = worker
+        self._by_watch_token[worker.watch_token] = worker
+
+    def remove(self, worker: SSHWorker):
+        record = self._records.pop(worker, None)
+        if record is None:
+            return
+
+        _discard(self._by_user, record.user_id, worker)
+        _discard(self._by_connection, record.connection_key, worker)
+        del self._by_token[record.token]
+        del self._by_watch_token[worker.watch_token]
+
+
+def _discard(index: Dict[Any, Set[SSHWorker]], key: Any, worker: SSHWorker):
+    workers = index[key]
+    workers.discard(worker)
+    if not workers:
+        del index[key]
+
+
+ssh_workers = WorkerRegistry()
+
+
+def remove_worker(worker: SSHWorker):
+    """ Destruct ``worker`` and remove it from ``ssh_workers`` """
+
+    worker.destruct()
+    ssh_workers.remove(worker)
+
+
+def viewer_count() -> int:
+    """ Number of clients watching terminals """
+    return sum(len(worker.viewers) for worker in ssh_workers)
+
+
+def worker_counts() -> Dict[str, int]:
+    """ Number of live workers by status, and of the ones destructed by the reaper """
+
+    counts = {'connected': 0, 'disconnected': 0}
+    for worker in ssh_workers:
+        counts['connected' if worker.is_connected else 'disconnected'] += 1
+    counts.update(reaper_stats)
+    return counts
+
+
+def evict_lru_workers(limit: int, user_id: Optional[int] = None) -> int:
+    """
+    Destruct disconnected workers in least recently used order until at most ``limit``
+    workers are left, of ``user_id`` if given. Connected workers are never evicted.
+    """
+
+    workers = list(ssh_workers) if user_id is None else ssh_workers.of_user(user_id)
+    excess = len(workers) - limit
+    if excess <= 0:
+        return 0
+
+    idle = sorted((w for w in workers if w.disconnected_at is not None),
+                  key=lambda w: w.disconnected_at)
+    for worker in idle[:excess]:
+        remove_worker(worker)
+        reaper_stats['evicted'] += 1
+    return min(excess, len(idle))
+
+
+def reap_idle_workers() -> int:
+    """ Destruct workers disconnected longer than ``settings.SSH_WORKER_TTL`` """
+
+    deadline = time.monotonic() - settings.SSH_WORKER_TTL
+    idle = [w for w in ssh_workers
+            if w.disconnected_at is not None and w.disconnected_at < deadline]
+    for worker in idle:
+        remove_worker(worker)
+        reaper_stats['reaped'] += 1
+
+    return len(idle) + evict_lru_workers(settings.SSH_MAX_WORKERS)
+
+
+async def run_reaper():
+    """ Destruct idle workers periodically """
+
+    while True:
+        await asyncio.sleep(settings.SSH_REAPER_INTERVAL)
+        try:
+            reap_idle_workers()
+        except Exception as e:
+            # TODO: send sentry
+            print(f'Failed to reap SSH workers: {e!r}')
+
+
+def start_reaper():
+    global reaper_task
 
-def ssh_connect(
+    if reaper_task is None or reaper_task.done():
+        reaper_task = asyncio.create_task(run_reaper())
+
+
+class TransportPool:
+    """
+    Share authenticated SSH connections among workers having the same target and
+    credentials. Additional terminals are opened as new channels on an existing
+    ``paramiko.Transport``, so they skip the TCP connection, key exchange and
+    authentication. A connection is closed when its last worker releases it.
+    """
+
+    def __init__(self):
+        self._clients: Dict[str, List[SSHClient]] = defaultdict(list)  # key: [client1, ...]
+        self._refs: Dict[SSHClient, int] = {}  # client: number of workers using it
+        self._keys: Dict[SSHClient, str] = {}  # client: key
+        self._connecting: Dict[str, asyncio.Task] = {}  # key: connecting task
+
+    def __len__(self):
+        return len(self._refs)
+
+    @staticmethod
+    def make_key(hostname: str, username: str, password: str, port: int) -> str:
+        sha = hashlib.sha256()
+        sha.update(f'{hostname}\0{port}\0{username}\0{password}'.encode())
+        return sha.hexdigest()
+
+    async def acquire(self, hostname: str, username: str, password: str, port: int) -> SSHClient:
+        """ Return a connected ``SSHClient``, reusing a shared connection if possible """
+
+        if not settings.SSH_SHARE_TRANSPORT:
+            return await run_blocking(connect_executor, _connect_client,
+                                      hostname, username, password, port)
+
+        key = self.make_key(hostname, username, password, port)
+        while True:
+            client = self._available(key)
+            if client is not None:
+                self._refs[client] += 1
+                return client
+
+            # Concurrent requests wait for the same handshake
+            task = self._connecting.get(key)
+            if task is None:
+                task = asyncio.ensure_future(self._connect(key, hostname, username, password, port))
+                self._connecting[key] = task
+            await asyncio.shield(task)
+
+    def release(self, client: Union[SSHClient, LocalPtyClient]):
+        """ Close ``client`` if no worker uses it anymore """
+
+        refs = self._refs.get(client)
+        if refs is None:
+            # Not shared
+            client.close()
+            return
+
+        if refs > 1:
+            self._refs[client] = refs - 1
+            return
+
+        key = self._keys.pop(client)
+        del self._refs[client]
+        if client in self._clients[key]:
+            self._clients[key].remove(client)
+        if not self._clients[key]:
+            del self._clients[key]
+        client.close()
+
+    def _available(self, key: str) -> Optional[SSHClient]:
+        """ Find alive connection having room for another channel """
+
+        for client in self._clients.get(key, []).copy():
+            transport = client.get_transport()
+            if transport is None or not transport.is_active():
+                # Do not hand out anymore. It is closed when its workers release it.
+                self._clients[key].remove(client)
+            elif self._refs[client] < settings.SSH_MAX_CHANNELS_PER_TRANSPORT:
+                return client
+        return None
+
+    async def _connect(self, key: str, hostname: str, username: str, password: str, port: int):
+        try:
+            client = await run_blocking(connect_executor, _connect_client,
+                                        hostname, username, password, port)
+        finally:
+            del self._connecting[key]
+
+        self._clients[key].append(client)
+        self._refs[client] = 0
+        self._keys[client] = key
+
+
+transport_pool = TransportPool()
+
+
+class WarmPool:
+    """
+    Workers whose shells are started before anyone asks for them, so that the startup
+    files of the login shell do not delay SSH_CONNECT. Their output(prompt) stays in
+    the channel until they are handed out and start relaying.
+
+    Spares are made for one target and credentials. They are replaced when the pool
+    is filled for others, ex. after the password is changed.
+
+    Spares are started only while no user waits for a shell(:meth:`deferred`), until the
+    prompt as well(:meth:`defer_until_output`), so that they never compete with the shells
+    users are waiting for.
+    """
+
+    DEFER_TIMEOUT = 30  # Seconds to wait for the prompt of a user at most
+
+    def __init__(self):
+        self._key: Optional[str] = None
+        self._target: Optional[tuple] = None  # (hostname, username, password, port) to fill for
+        self._workers: List[SSHWorker] = []
+        self._filling: Optional[asyncio.Task] = None
+        self._waiting = 0  # Number of users waiting for a new shell
+        self._idle: Optional[asyncio.Event] = None  # Set when ``_waiting`` is 0. Made on the event loop.
+
+    def __len__(self):
+        return len(self._workers)
+
+    def take(self, hostname: str, username: str, password: str, port: int) -> Optional[SSHWorker]:
+        """ Return a spare worker for the target, if any """
+
+        if self._key != transport_pool.make_key(hostname, username, password, port):
+            return None
+
+        while self._workers:
+            worker = self._workers.pop(0)
+            if worker.is_reusable:
+                return worker
+            worker.destruct()
+        return None
+
+    def fill(self, hostname: str, username: str, password: str, port: int) -> Optional[asyncio.Task]:
+        """ Start up to ``settings.SSH_WARM_WORKERS`` spare workers in the background """
+
+        if not settings.SSH_WARM_WORKERS:
+            return None
+        # A running fill picks up new credentials before starting the next spare
+        self._target = (hostname, username, password, port)
+        if self._filling is None or self._filling.done():
+            self._filling = asyncio.ensure_future(self._fill())
+        return self._filling
+
+    @contextmanager
+    def deferred(self):
+        """ Hold off starting spares while a user waits for a shell started in the block """
+
+        self._hold()
+        try:
+            yield
+        finally:
+            self._release()
+
+    def defer_until_output(self, worker: SSHWorker):
+        """ Hold off starting spares until ``worker`` outputs the prompt. Login shells are slow to start. """
+
+        self._hold()
+        asyncio.ensure_future(self._release_on(worker.output_started))
+
+    def clear(self):
+        for worker in self._workers:
+            worker.destruct()
+        self._workers = []
+
+    async def _fill(self):
+        while True:
+            await self._get_idle().wait()
+            if self._waiting:
+                # Another user came before this woke up
+                continue
+
+            key = transport_pool.make_key(*self._target)
+            if key != self._key:
+                self.clear()
+                self._key = key
+            if len(self._workers) >= settings.SSH_WARM_WORKERS:
+                return
+
+            try:
+                worker = await start_worker(None, None, *self._target)
+            except SSHConnectionException as e:
+                print(f'Failed to warm up a shell: {e}')
+                return
+
+            if transport_pool.make_key(*self._target) == key:
+                self._workers.append(worker)
+            else:
+                # Credentials changed while starting it
+                worker.destruct()
+
+    async def _release_on(self, event: asyncio.Event):
+        try:
+            await asyncio.wait_for(event.wait(), self.DEFER_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self._release()
+
+    def _hold(self):
+        self._waiting += 1
+        self._get_idle().clear()
+
+    def _release(self):
+        self._waiting -= 1
+        if not self._waiting:
+            self._get_idle().set()
+
+    def _get_idle(self) -> asyncio.Event:
+        if self._idle is None:
+            self._idle = asyncio.Event()
+            if not self._waiting:
+                self._idle.set()
+        return self._idle
+
+
+warm_pool = WarmPool()
+
+
+async def warm_up(hostname: str, username: str, password: str, port: int):
+    """ Fill ``warm_pool`` and wait for it """
+
+    task = warm_pool.fill(hostname, username, password, port)
+    if task is not None:
+        await task
+
+
+def wait_readable(loop: asyncio.AbstractEventLoop, fd: int) -> asyncio.Future:
+    """ Return a future which is resolved once ``fd`` becomes readable """
+
+    fut = loop.create_future()
+
+    def on_readable():
+        if not fut.done():
+            fut.set_result(None)
+
+    loop.add_reader(fd, on_readable)
+    fut.add_done_callback(lambda _: loop.remove_reader(fd))
+    return fut
+
+
+async def ssh_connect(
     sid: str,
     user: User,
     hostname: str,
     username: str,
     auth_type: str,
     auth: str,
-    port: int = 22
+    port: int = 22,
+    resume: Optional[str] = None
 ) -> SSHWorker:
     """
     Connect with SSH server running in the local machine, that is to run user's
-    code.
+    code. Blocking handshake and shell invocation run on ``connect_executor``.
 
     :param str sid: socket.io session ID
     :param User user: client data
@@ -237,50 +798,112 @@ def ssh_connect(
     :param str auth_type: SSH authentication method (ex. password)
     :param str auth: SSH authentication payload (ex. raw password)
     :param int port: SSH port
+    :param str resume: resume token of the worker to reattach
     :return:
     """
     if auth_type != 'password':
         raise SSHConnectionException(Reason.SSH_AUTH_NOT_SUPPORT.format(auth_type))
 
-    if len(ssh_clients[str(user)]) > MAX_SSH_CONNECTION:
-        raise SSHConnectionException(Reason.SSH_TOO_MANY)
-
-    # When there is already connected ssh client disconnected with the user,
-    # reuse that ssh client.
     connection_info = ConnectionInfo(user=user, ssh_user=username,
                                      src=user.ip, dest=hostname,
                                      port=port)
 
-    for worker in ssh_clients[connection_info.key].copy():
+    # When there is already connected ssh client disconnected with the user,
+    # reuse that ssh client.
+    candidates = ssh_workers.of_connection(connection_info.key)
+    if resume:
+        # The worker of the token comes first, even if the IP of the user changed
+        worker = ssh_workers.by_token(resume, user.user_id)
+        if worker is not None:
+            candidates = [worker] + [w for w in candidates if w is not worker]
+
+    for worker in candidates:
         if worker.status == WorkerStatus.DISCONNECTED:
             if worker.is_reusable:
-                worker.setup_recycle(sid, connection_info)
+                ssh_workers.add(worker, connection_info)
                 worker.sio_accepted(sid)
+                await worker.setup_recycle(sid, connection_info)
                 return worker
             else:
                 # Don't need to reuse the worker because of broken channel.
-                worker.destruct()
-                ssh_clients[connection_info.key].remove(worker)
+                remove_worker(worker)
                 del worker
 
-    client = SSHClient()
-    client.load_system_host_keys()
-    client.set_missing_host_key_policy(AutoAddPolicy)
+    if ssh_workers.user_count(user.user_id) >= MAX_SSH_CONNECTION:
+        # Make room by the least recently used terminal of the user
+        evict_lru_workers(MAX_SSH_CONNECTION - 1, user.user_id)
+        if ssh_workers.user_count(user.user_id) >= MAX_SSH_CONNECTION:
+            raise SSHConnectionException(Reason.SSH_TOO_MANY)
+
+    if len(ssh_workers) >= settings.SSH_MAX_WORKERS:
+        # Make room for the new one
+        evict_lru_workers(settings.SSH_MAX_WORKERS - 1)
+        if len(ssh_workers) >= settings.SSH_MAX_WORKERS:
+            raise SSHConnectionException(Reason.SSH_TOO_MANY_TOTAL)
+
+    # Hand out a shell started in advance, whose prompt is already waiting in the channel
+    ssh_worker = warm_pool.take(hostname, username, auth, port)
+    if ssh_worker is not None:
+        ssh_worker.sid = sid
+        ssh_worker.connection_info = connection_info
+    else:
+        with warm_pool.deferred():
+            ssh_worker = await start_worker(sid, connection_info, hostname, username, auth, port)
+            warm_pool.defer_until_output(ssh_worker)
+
+    ssh_workers.add(ssh_worker, connection_info)
+    warm_pool.fill(hostname, username, auth, port)
+    return ssh_worker
+
+
+async def start_worker(sid: Optional[str], connection_info: Optional[ConnectionInfo],
+                       hostname: str, username: str, password: str, port: int) -> SSHWorker:
+    """ Create a worker with a new shell """
 
     try:
-        client.connect(hostname=hostname,
-                       username=username,
-                       password=auth,
-                       port=port,
-                       compress=True,
-                       )
+        if settings.TERMINAL_BACKEND == 'pty':
+            # The shell runs on this machine. No need to authenticate.
+            client = LocalPtyClient(settings.USERNAME)
+        else:
+            client = await transport_pool.acquire(hostname, username, password, port)
     except paramiko.AuthenticationException:
         raise SSHConnectionException(Reason.SSH_AUTH_FAIL)
     except Exception as e:
         raise SSHConnectionException(Reason.SSH_FAIL)
 
     ssh_worker = SSHWorker(sid, connection_info, client)
-    ssh_worker.channel.settimeout(0)
-
-    ssh_clients[connection_info.key].add(ssh_worker)
+    try:
+        await ssh_worker.set_ssh_channel()
+    except (SSHStopRetryException, IOError):
+        transport_pool.release(client)
+        raise SSHConnectionException(Reason.SSH_FAIL)
     return ssh_worker
+
+
+def _connect_client(hostname: str, username: str, password: str, port: int) -> SSHClient:
+    """ Blocking part of ``ssh_connect`` """
+
+    client = SSHClient()
+    client.load_system_host_keys()
+    client.set_missing_host_key_policy(AutoAddPolicy)
+    client.connect(hostname=hostname,
+                   username=username,
+                   password=password,
+                   port=port,
+                   compress=use_compression(hostname),
+                   )
+    return client
+
+
+def use_compression(hostname: str) -> bool:
+    """ Whether to compress the SSH connection to ``hostname``. Loopback traffic never leaves the machine. """
+
+    if settings.SSH_COMPRESS is not None:
+        return settings.SSH_COMPRESS
+
+    if hostname == 'localhost':
+        return False
+    try:
+        return not ipaddress.ip_address(hostname).is_loopback
+    except ValueError:  # Domain name
+        return True
@@ -0,0 +1,493 @@
+import os
+import re
+import pwd
+import json
+import codecs
+import stat
+import shutil
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from configs import settings
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _read_umask() -> int:
+    """
+    umask of this process. It is read from /proc, because ``os.umask`` can only be read by
+    setting it, which affects files created by the other threads meanwhile.
+    """
+    try:
+        with open('/proc/self/status', 'rt') as fp:
+            for line in fp:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):
+        pass
+    return 0o022
+
+
+# Permission of new files, as if they were created by ``open``
+FILE_MODE = 0o666 & ~_read_umask()
+
+executor = ThreadPoolExecutor(max_workers=settings.RUN_WRITE_WORKERS, thread_name_prefix='workspace')
+
+
+class JsonObjectStream:
+    """
+    Parse a JSON object from chunks of bytes incrementally, and iterate its
+    (key, value) pairs without loading the whole document into memory.
+    Only one value is held at a time.
+    """
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self) -> Iterator[Tuple[str, Any]]:
+        self._expect('{')
+        if self._peek() == '}':
+            self._pos += 1
+            return
+
+        while True:
+            key = self._value()
+            if not isinstance(key, str):
+                raise ValueError(f'Object key must be a string: {key!r}')
+            self._expect(':')
+            yield key, self._value()
+
+            char = self._peek()
+            self._pos += 1
+            if char == '}':
+                return
+            if char != ',':
+                raise ValueError(f'Expected `,` or `}}` but `{char}` found')
+
+    def _fill(self, size: int):
+        """ Read chunks until at least ``size`` characters are pending, or EOF """
+
+        parts = [self._buf[self._pos:]]
+        pending = len(parts[0])
+        for chunk in self._chunks:
+            text = self._utf8.decode(chunk)
+            parts.append(text)
+            pending += len(text)
+            if pending >= size:
+                break
+        else:
+            self._eof = True
+            parts.append(self._utf8.decode(b'', final=True))
+
+        self._buf = ''.join(parts)
+        self._pos = 0
+
+    def _peek(self) -> str:
+        """ Skip whitespaces and return the next character without consuming it """
+
+        while True:
+            self._pos = _WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if self._eof:
+                raise ValueError('Unexpected end of JSON')
+            self._fill(1)
+
+    def _expect(self, char: str):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f'Expected `{char}` but `{found}` found')
+        self._pos += 1
+
+    def _value(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buf, self._pos)
+                # A number at the end of the buffer might continue in the next chunk
+                if end < len(self._buf) or self._eof:
+                    self._pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self._eof:
+                    raise
+
+            # Incomplete value. Wait until the pending part doubles not to parse it over and over.
+            self._fill(2 * (len(self._buf) - self._pos))
+
+
+class Manifest:
+    """
+    Content hash, size and mtime of the files written into a workspace.
+    A file whose hash is unchanged and whose size and mtime on disk are the same as
+    recorded is known to be up to date without reading it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.files: Dict[str, dict] = {}  # relative path: {'hash': ..., 'size': ..., 'mtime': ...}
+
+        try:
+            with open(path, 'rt') as fp:
+                self.files = json.load(fp)
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def of(cls, root: str) -> 'Manifest':
+        """ Manifest of the workspace ``root``, kept out of the workspace """
+        name = hashlib.md5(os.path.realpath(root).encode()).hexdigest()
+        return cls(os.path.join(settings.AGENT_DIRECTORY, '.manifests', f'{name}.json'))
+
+    def hashes(self) -> Dict[str, str]:
+        return {path: entry['hash'] for path, entry in self.files.items()}
+
+    def is_fresh(self, path: str, digest: str, dest: str) -> bool:
+        """ Whether ``dest`` on disk is the one recorded with ``digest`` """
+        entry = self.files.get(path)
+        if not entry or entry['hash'] != digest:
+            return False
+        try:
+            stat = os.stat(dest)
+        except OSError:
+            return False
+        return stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime']
+
+    def record(self, path: str, digest: str, dest: str):
+        stat = os.stat(dest)
+        self.files[path] = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'wt') as fp:
+            json.dump(self.files, fp, separators=(',', ':'))
+        os.replace(tmp, self.path)
+
+
+class WorkspaceWriter:
+    """
+    Write files into ``root`` on a bounded pool of threads.
+
+    Each file is written into a temporary file and renamed, so that a running program
+    never sees a partially written file. Directories are created once, and the
+    ownership is set only on the files and directories newly written.
+
+    With ``manifest``, files known to be up to date are skipped without any disk read,
+    and on :meth:`finish` files not submitted this time are deleted.
+    """
+
+    def __init__(self, root: str, username: Optional[str] = None,
+                 manifest: Optional[Manifest] = None):
+        self.root = os.path.realpath(root)
+        self.manifest = manifest
+        self.stats = {'written': 0, 'unchanged': 0, 'deleted': 0, 'bytes': 0}
+        self._submitted: Set[str] = set()  # Relative paths
+
+        self._owner: Optional[Tuple[int, int]] = None
+        if username and os.geteuid() == 0:
+            pw = pwd.getpwnam(username)
+            self._owner = (pw.pw_uid, pw.pw_gid)
+
+        self._lock = threading.Lock()
+        self._dirs: Set[str] = set()  # Directories known to exist
+        self._futures: List[Future] = []
+        # Bound the number of contents waiting to be written
+        self._slots = threading.BoundedSemaphore(settings.RUN_WRITE_WORKERS * 2)
+
+        self._makedirs(self.root)
+
+    def resolve(self, path: str) -> str:
+        """
+        Absolute path of ``path`` in the workspace. Paths escaping it are refused.
+        Symbolic links in the workspace are checked by ``_check_inside`` before writing.
+        """
+
+        dest = os.path.normpath(os.path.join(self.root, path.lstrip('/')))
+        if dest == self.root or not dest.startswith(self.root + os.sep):
+            raise ValueError(f'Invalid path: {path}')
+        return dest
+
+    def submit(self, path: str, content: Optional[str]):
+        """
+        Schedule writing ``content`` into ``path``. Block while writers are busy.
+        ``None`` content means that the file is unchanged from the manifest.
+        """
+
+        dest = self.resolve(path)
+        rel = os.path.relpath(dest, self.root)
+        self._submitted.add(rel)
+
+        if content is None and self.manifest and rel in self.manifest.files:
+            self._count('unchanged', 0)
+            return
+        if not isinstance(content, str):
+            raise ValueError(f'Invalid content: {path}')
+
+        self._slots.acquire()
+        try:
+            future = executor.submit(self._write, rel, dest, content.encode())
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def wait(self) -> Dict[str, int]:
+        """ Wait for every scheduled file to be written, and return statistics """
+
+        wait(self._futures)
+        futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()  # Raise the error if any
+        return dict(self.stats)
+
+    def finish(self, delete: bool = True) -> Dict[str, int]:
+        """
+        Wait for every scheduled file to be written, delete files in the manifest
+        but not submitted if ``delete``, and save the manifest.
+        """
+
+        try:
+            self.wait()
+            if self.manifest and delete:
+                for rel in set(self.manifest.files) - self._submitted:
+                    self._delete(rel)
+        finally:
+            if self.manifest:
+                self.manifest.save()
+        return dict(self.stats)
+
+    def _write(self, rel: str, dest: str, data: bytes):
+        digest = hashlib.sha256(data).hexdigest()
+        if self.manifest and self.manifest.is_fresh(rel, digest, dest):
+            self._count('unchanged', 0)
+            return
+
+        if (not self.manifest or rel not in self.manifest.files) and self._is_unchanged(dest, data):
+            # Unknown file. Compare contents not to write the same one.
+            self._record(rel, digest, dest)
+            self._count('unchanged', 0)
+            return
+
+        directory = os.path.dirname(dest)
+        self._makedirs(directory)
+        self._check_inside(directory)
+
+        # Keep the permission of the file replaced, ex. executable bit set by the user
+        try:
+            st = os.lstat(dest)
+            mode = stat.S_IMODE(st.st_mode) if stat.S_ISREG(st.st_mode) else FILE_MODE
+        except FileNotFoundError:
+            mode = FILE_MODE
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(data)
+            os.chmod(tmp, mode)
+            self._chown(tmp)
+            os.replace(tmp, dest)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+        self._record(rel, digest, dest)
+        self._count('written', len(data))
+
+    def _record(self, rel: str, digest: str, dest: str):
+        if self.manifest:
+            with self._lock:
+                self.manifest.record(rel, digest, dest)
+
+    def _delete(self, rel: str):
+        """ Delete a file removed from the project, and its directories if they get empty """
+
+        self.manifest.files.pop(rel, None)
+        try:
+            dest = self.resolve(rel)
+            self._check_inside(os.path.dirname(dest))
+            os.unlink(dest)
+        except (ValueError, FileNotFoundError):
+            return
+        self._count('deleted', 0)
+
+        directory = os.path.dirname(dest)
+        while directory != self.root:
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # Not empty
+                break
+            self._dirs.discard(directory)
+            directory = os.path.dirname(directory)
+
+    @staticmethod
+    def _is_unchanged(dest: str, data: bytes) -> bool:
+        try:
+            if os.path.getsize(dest) != len(data):
+                return False
+            with open(dest, 'rb') as fp:
+                return fp.read() == data
+        except OSError:
+            return False
+
+    def _makedirs(self, directory: str):
+        if directory in self._dirs:
+            return
+
+        with self._lock:
+            missing = []
+            path = directory
+            while path not in self._dirs and not os.path.isdir(path):
+                missing.append(path)
+                path = os.path.dirname(path)
+            if missing and directory != self.root:
+                self._check_inside(path)
+
+            for path in reversed(missing):
+                try:
+                    os.mkdir(path)
+                except FileExistsError:
+                    continue
+                self._chown(path)
+            self._dirs.add(directory)
+
+    def _check_inside(self, directory: str):
+        """ Refuse ``directory`` reached through a symbolic link pointing out of the workspace """
+        real = os.path.realpath(directory)
+        if real != self.root and not real.startswith(self.root + os.sep):
+            raise ValueError(f'Invalid path: {os.path.relpath(directory, self.root)}')
+
+    def _chown(self, path: str):
+        if self._owner:
+            os.chown(path, *self._owner)
+
+    def _count(self, key: str, size: int):
+        with self._lock:
+            self.stats[key] += 1
+            self.stats['bytes'] += size
+
+
+class WorkspaceCache:
+    """
+    Workspaces of participants kept side by side in ``cache_dir``.
+    ``link`` is a symlink to the active one, and switching participants only flips it
+    atomically. Least recently used workspaces are deleted when the cache grows over
+    ``budget`` bytes. Sizes are taken from the manifests, not by walking the workspaces.
+
+    A directory found at ``link`` is moved aside only with ``adopt``. It is kept as
+    ``LEGACY_NAME`` and never deleted, as it may hold files the IDE server does not know.
+
+    Shells keep the directory they started in, so terminals must ``cd`` again after a switch.
+    """
+
+    LEGACY_NAME = 'legacy'  # Where a directory found at ``link`` is moved into
+
+    def __init__(self, link: str, cache_dir: str, budget: int, adopt: bool = False):
+        self.link = os.path.abspath(link)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.budget = budget
+        self.adopt = adopt
+        self._usage: Dict[str, int] = {}  # path: disk usage of a workspace without manifest
+
+    def path_of(self, ptc_id: int) -> str:
+        return os.path.join(self.cache_dir, f'ptc-{ptc_id}')
+
+    def prepare(self) -> bool:
+        """
+        Make ``link`` ready to be flipped. A real directory at ``link`` is moved into
+        the cache with ``adopt``. Return False if it is not allowed or impossible (ex. a mount point).
+        """
+
+        if os.path.islink(self.link) or not os.path.exists(self.link):
+            return True
+        if not self.adopt:
+            return False
+
+        legacy = os.path.join(self.cache_dir, self.LEGACY_NAME)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            os.rename(self.link, legacy)
+        except OSError:
+            return False
+
+        self._flip(legacy)
+        return True
+
+    def activate(self, ptc_id: int):
+        """ Point ``link`` to the workspace of ``ptc_id`` """
+
+        path = self.path_of(ptc_id)
+        self._flip(path)
+        os.utime(path)  # Mark as recently used
+        self._usage.pop(path, None)
+
+    def evict(self):
+        """ Delete least recently used workspaces but the active one until the cache fits in the budget """
+
+        try:
+            active = os.path.realpath(self.link)
+            entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+        except OSError:
+            return
+
+        workspaces = []
+        for path in entries:
+            if os.path.basename(path) == self.LEGACY_NAME:
+                continue
+            if os.path.isdir(path) and not os.path.islink(path):
+                workspaces.append((os.stat(path).st_mtime, path, self._size_of(path)))
+
+        total = sum(size for _, _, size in workspaces)
+        for _, path, size in sorted(workspaces):
+            if total <= self.budget:
+                break
+            if path == active:
+                continue
+
+            shutil.rmtree(path, ignore_errors=True)
+            try:
+                os.unlink(Manifest.of(path).path)
+            except OSError:
+                pass
+            self._usage.pop(path, None)
+            total -= size
+
+    def _size_of(self, path: str) -> int:
+        """ Bytes of the files written into the workspace """
+
+        manifest = Manifest.of(path)
+        if manifest.files:
+            return sum(entry['size'] for entry in manifest.files.values())
+
+        # Without ``settings.RUN_SYNC``. Measured once until it is activated again.
+        if path not in self._usage:
+            self._usage[path] = _disk_usage(path)
+        return self._usage[path]
+
+    def _flip(self, target: str):
+        tmp = f'{self.link}.{os.getpid()}.tmp'
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(target, tmp)
+        os.replace(tmp, self.link)
+
+
+def _disk_usage(path: str) -> int:
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except OSError:
+                pass
+    return total
@@ -0,0 +1,44 @@
+"""
+permessage-deflate of websocket connections with a tunable level and size threshold.
+
+uvicorn only switches permessage-deflate of `websockets` on and off, and it compresses
+every message including one-byte keystroke echoes. Here small messages are sent
+uncompressed(RSV1 unset), which RFC 7692 allows within a compressed connection.
+"""
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.frames import OP_BINARY, OP_TEXT
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+
+from configs import settings
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    def encode(self, frame):
+        # Only unfragmented messages can be skipped, as continuation frames follow the first one.
+        if frame.opcode in (OP_TEXT, OP_BINARY) and frame.fin \
+                and len(frame.data) < settings.WS_COMPRESSION_THRESHOLD:
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdPerMessageDeflateFactory(ServerPerMessageDeflateFactory):
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(extension.remote_no_context_takeover,
+                                                           extension.local_no_context_takeover,
+                                                           extension.remote_max_window_bits,
+                                                           extension.local_max_window_bits,
+                                                           self.compress_settings)
+
+
+class CompressionWebSocketProtocol(WebSocketProtocol):
+    """ uvicorn websocket protocol negotiating compression by ``WS_COMPRESSION`` settings """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        if settings.WS_COMPRESSION:
+            compress_settings = {'level': settings.WS_COMPRESSION_LEVEL, 'memLevel': 5}
+            self.available_extensions = [ThresholdPerMessageDeflateFactory(compress_settings=compress_settings)]
+        else:
+            self.available_extensions = []
@@ -1,10 +1,36 @@
-from typing import Any, List, Optional
+from typing import Any, List, Optional, Tuple
 
 from server import sio
 
 
 def is_connected(sid, namespaces: str = None):
-    return sio.manager.is_connected(sid, namespaces)
+    return bool(sio.manager.is_connected(sid, namespaces or '/'))
+
+
+def pending_packets(sid: str, namespace: str = None) -> int:
+    """ Number of packets queued for ``sid`` that are not delivered to the client yet """
+    try:
+        eio_sid = sio.manager.eio_sid_from_sid(sid, namespace or '/')
+    except KeyError:
+        return 0
+    return eio_pending_packets(eio_sid)
+
+
+def eio_pending_packets(eio_sid: str) -> int:
+    """ ``pending_packets`` by engine.io session ID """
+    try:
+        socket = sio.eio._get_socket(eio_sid)
+    except KeyError:
+        return 0
+    return socket.queue.qsize()
+
+
+def room_members(room: str, namespace: str = None) -> List[Tuple[str, str]]:
+    """ (sid, engine.io sid) of the clients in ``room`` """
+    try:
+        return list(sio.manager.get_participants(namespace or '/', room))
+    except KeyError:  # Nobody is connected to the namespace
+        return []
 
 
 async def get(sid: str, key: str, namespaces: str = None) -> Any:
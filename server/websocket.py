@@ -1,17 +1,30 @@
 import socketio
 from fastapi import FastAPI
 
+from configs import settings
+
 
 def create_websocket(app: FastAPI):
-    sio = socketio.AsyncServer(cors_allowed_origins='*', async_mode='asgi')
+    # With several processes, long-polling requests of a session could reach different
+    # processes. A websocket connection is owned by the process that accepted it, so
+    # the session and its SSH workers stay in one process.
+    transports = ['websocket'] if settings.AGENT_WORKERS > 1 else ['polling', 'websocket']
+    # Websocket messages are compressed by the protocol of agent.py. See utils/ws_compression.py
+    # Long-polling responses keep the compression defaults of engine.io.
+    sio = socketio.AsyncServer(cors_allowed_origins='*', async_mode='asgi', transports=transports)
     return sio, socketio.ASGIApp(sio, app)
 
 
 class InEvent:
-    SSH_CONNECT = 'SSH_CONNECT'  # SSH connection request
+    SSH_CONNECT = 'SSH_CONNECT'  # SSH connection request. `resume` reattaches the terminal of SSH_RESUME.
     SSH = 'SSH'  # Communicate with SSH terminal
     SSH_RESIZE = 'SSH_RESIZE'  # Resize pty
+    SSH_WATCH = 'SSH_WATCH'  # Watch a terminal read-only, by `token`(`watch` of SSH_RESUME)
+    SSH_UNWATCH = 'SSH_UNWATCH'
     AUTHENTICATE = 'AUTHENTICATE'
+    RUN = 'RUN'  # Execute a program
+    RUN_STDIN = 'RUN_STDIN'  # Write into stdin of the program. Null closes it.
+    RUN_CANCEL = 'RUN_CANCEL'  # Kill the program
 
 
 class OutEvent:
@@ -20,12 +33,18 @@ class OutEvent:
     AUTHENTICATE = 'AUTHENTICATE'
     SSH_RELAY = 'SSH_RELAY'
     SSH_DOWN = 'SSH_DOWN'
+    SSH_RESUME = 'SSH_RESUME'  # Token to reattach the terminal, as `resume` of SSH_CONNECT, and to watch it
+    SSH_WATCH_RELAY = 'SSH_WATCH_RELAY'  # Output of the watched terminal
+    RUN_STDOUT = 'RUN_STDOUT'
+    RUN_STDERR = 'RUN_STDERR'
+    RUN_EXIT = 'RUN_EXIT'  # Exit code of the program and why it exited
 
 
 class ErrorType:
     AUTH = 'auth'
     UNKNOWN = 'unknown'
     MISSING_FIELD = 'missing field'
+    INVALID_FIELD = 'invalid field'
     COMMON = 'common'
     SSH = 'ssh'
     INIT_NEEDED = 'Init Needed'